@@ -0,0 +1,152 @@
+'''
+    benchmark.py
+'''
+import random
+import time
+import numpy as np
+import torch
+from dataset import Instance, Kpi, Alarm, InstanceToInstance, KpiAlarmToInstance
+from meta_path import MetaPath, WalkStream
+from model import SimiModel
+from skip_gram import SkipGramWithType
+from tokenizer import Tokenizer
+from trainer import train_hogwild
+from utils.dataloader import DictDataLoader
+from utils.graph import Graph
+from utils.optim import RowWiseAdagrad
+
+def synthetic_graph(instance_num: int, kpi_num=5, alarm_num=1, degree=3) -> Graph:
+    '''
+        build a random graph shaped like prior knowledge graph:
+        instances linked to `degree` random instances, and each instance
+        owns `kpi_num` kpis and `alarm_num` alarms.
+    '''
+    graph = Graph()
+    instances = [Instance(str(i)) for i in range(0, instance_num)]
+    for vertex in instances:
+        graph.add_vertex(vertex)
+    for vh in instances:
+        for vt in random.sample(instances, degree):
+            edge = InstanceToInstance('support')
+            graph.add_edge(vh, vt, edge)
+            graph.add_edge(vt, vh, edge)
+    for i, vt in enumerate(instances):
+        vertices = [Kpi(f'{i}_{j}', '', '', '') for j in range(0, kpi_num)]
+        vertices += [Alarm(f'{i}_{j}', '') for j in range(0, alarm_num)]
+        for vh in vertices:
+            edge = KpiAlarmToInstance()
+            graph.add_vertex(vh)
+            graph.add_edge(vh, vt, edge)
+            graph.add_edge(vt, vh, edge)
+    return graph
+
+def bench_walk(instance_nums=(100, 1000, 10000), step_num=100000):
+    '''
+        Graph.random_adj step throughput while vertices num grows,
+        should keep flat if walk step cost is independent of N.
+    '''
+    for instance_num in instance_nums:
+        graph = synthetic_graph(instance_num)
+        graph.csr()
+        vertices = [graph.vertices[random.randrange(0, instance_num)] for _ in range(0, 1000)]
+        categories = [random.choice((Instance, Kpi, Alarm)) for _ in range(0, 1000)]
+        start = time.time()
+        for i in range(0, step_num):
+            graph.random_adj(vertices[i % 1000], categories[i % 1000])
+        cost = time.time() - start
+        print(f'[bench_walk]: {len(graph.vertices)} vertices, '
+              f'{step_num} steps in {cost:.2f}s, {step_num / cost:.0f} steps/s')
+
+def bench_batch_walk(instance_nums=(100, 1000, 10000, 100000)):
+    '''
+        vectorized batch walk throughput while vertices num grows.
+    '''
+    for instance_num in instance_nums:
+        graph = synthetic_graph(instance_num)
+        meta_path = MetaPath(graph)
+        meta_path.add([(Alarm, Kpi), ('*1-3', Instance), (Kpi, Alarm)], 5)
+        graph.csr()
+        start = time.time()
+        walk_num = len(meta_path.batch_walk(rng=np.random.default_rng(0)))
+        cost = time.time() - start
+        print(f'[bench_batch_walk]: {len(graph.vertices)} vertices, '
+              f'{walk_num} walks in {cost:.2f}s, {walk_num / cost:.0f} walks/s')
+
+def _owner_auc(model: SimiModel, graph: Graph) -> float:
+    # auc of scoring kpi with its owner instance above kpi with a random instance.
+    csr = graph.csr()
+    kpis = np.flatnonzero(csr.categories == graph.category_ids[Kpi.__name__])
+    instances = np.flatnonzero(csr.categories == graph.category_ids[Instance.__name__])
+    owners = csr.indices[csr.indptr[kpis * csr.category_num + graph.category_ids[Instance.__name__]]]
+    others = np.random.default_rng(0).choice(instances, len(kpis))
+    with torch.no_grad():
+        pos = model(torch.from_numpy(kpis), torch.from_numpy(owners.astype(np.int64)))
+        neg = model(torch.from_numpy(kpis), torch.from_numpy(others))
+    return (pos[:, None] > neg[None, :]).float().mean().item()
+
+def bench_subsample(thresholds=(None, 1e-4, 3e-5, 1e-5), instance_num=1000, rounds=3):
+    '''
+        examples num, generation time and embedding quality (kpi to owner
+        instance auc) with frequent token subsampling and dynamic window.
+    '''
+    graph = synthetic_graph(instance_num)
+    meta_path = MetaPath(graph)
+    meta_path.add([(Alarm, Kpi), ('*1-3', Instance), (Kpi, Alarm)], 5)
+    tokenizer = Tokenizer(graph.vertices)
+    corpus = WalkStream(meta_path, seed=0, transform=tokenizer.encode_walks)
+    for dynamic_window in (False, True):
+        for threshold in thresholds:
+            torch.manual_seed(0)
+            start = time.time()
+            skip_gram = SkipGramWithType(corpus, tokenizer.categories, {
+                'SUBSAMPLE_THRESHOLD': threshold, 'DYNAMIC_WINDOW': dynamic_window, 'SEED': 0})
+            positives = skip_gram.generate_positives()
+            cost = time.time() - start
+
+            # train a small model on cpu.
+            model = SimiModel(tokenizer.vocabulary_size(), {'EMBEDDING_SIZE': 32})
+            sampler = skip_gram.negative_sampler()
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+            for _ in range(0, rounds):
+                for batch in DictDataLoader(positives, {'batch_size': 4096, 'shuffle': True}):
+                    batch = sampler(batch)
+                    y = batch.pop('y')
+                    loss = -torch.log(torch.sigmoid(y * model(**batch)))[y != 0].mean(-1)
+                    loss.backward()
+                    optimizer.step()
+                    optimizer.zero_grad()
+            print(f'[bench_subsample]: threshold {threshold}, dynamic window {dynamic_window}, '
+                  f'{len(positives["x1"])} positives in {cost:.2f}s, auc {_owner_auc(model, graph):.3f}')
+
+def bench_hogwild(workers=(1, 2, 4), instance_num=1000, rounds=2):
+    '''
+        hogwild cpu training throughput while process num grows,
+        should grow close to linearly until cpu cores run out.
+    '''
+    graph = synthetic_graph(instance_num)
+    meta_path = MetaPath(graph)
+    meta_path.add([(Alarm, Kpi), ('*1-3', Instance), (Kpi, Alarm)], 5)
+    tokenizer = Tokenizer(graph.vertices)
+    corpus = WalkStream(meta_path, seed=0, transform=tokenizer.encode_walks)
+    skip_gram = SkipGramWithType(corpus, tokenizer.categories, {'SEED': 0})
+    positives = skip_gram.generate_positives()
+    for worker_num in workers:
+        torch.manual_seed(0)
+        model = SimiModel(tokenizer.vocabulary_size(), {'EMBEDDING_SIZE': 32, 'SPARSE': True})
+        optimizer = RowWiseAdagrad(model.parameters(), lr=2e-1)
+        start = time.time()
+        train_hogwild(model, optimizer, positives, skip_gram.negative_sampler(), worker_num, rounds, 4096)
+        cost = time.time() - start
+        print(f'[bench_hogwild]: {worker_num} workers, {rounds * len(positives["x1"]) / cost:.0f} '
+              f'positives/s, auc {_owner_auc(model, graph):.3f}')
+
+def main():
+    ''' main '''
+    random.seed(0)
+    bench_walk()
+    bench_batch_walk()
+    bench_subsample()
+    bench_hogwild()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+    checkpoint.py
+'''
+import json
+import os
+from typing import Dict, List, Tuple
+import numpy as np
+import torch
+from model import SimiModel
+from utils.graph import Graph
+
+class Checkpoint():
+    '''
+        structured checkpoint dir, each part is a separate file loaded on demand:
+          config.json: version and SimiModel config.
+          model/{name}.npy: each tensor of SimiModel state dict, embs.weight.npy
+          is center embeddings matrix.
+          optimizer.pt: optimizer state dict, optional.
+          vocabulary.npz: uuid and category id of each token, category names.
+          graph.npz: graph snapshot of Graph.to_arrays, optional.
+        [PARAMS]
+          `root`: checkpoint dir, written by Checkpoint.save.
+    '''
+
+    # checkpoint format version.
+    VERSION = 1
+
+    # SimiModel configs saved.
+    MODEL_CONFIG = ('EMBEDDING_SIZE', 'SPARSE', 'SEPARATE_CONTEXT')
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, 'config.json')) as config:
+            self.config = json.load(config)
+        if self.config.get('version') != self.VERSION:
+            raise AssertionError(f'unsupported checkpoint version: {self.config.get("version")}')
+
+    @classmethod
+    def save(cls, root: str, model: SimiModel, tokenizer, optimizer=None, graph: Graph = None) -> 'Checkpoint':
+        '''
+            save model, vocabulary of tokenizer, and optionally optimizer state and graph.
+        '''
+        # config is removed first and written last, so an interrupted saving over
+        # an old checkpoint leaves no checkpoint, instead of old config with new parts.
+        os.makedirs(os.path.join(root, 'model'), exist_ok=True)
+        if os.path.exists(os.path.join(root, 'config.json')):
+            os.remove(os.path.join(root, 'config.json'))
+        state = model.state_dict()
+        for name, tensor in state.items():
+            np.save(os.path.join(root, 'model', f'{name}.npy'), tensor.detach().cpu().numpy())
+
+        category_names = sorted(tokenizer.category_to_id, key=tokenizer.category_to_id.get)
+        np.savez(os.path.join(root, 'vocabulary.npz'),
+                 uuids=np.array(tokenizer.uuids, dtype=str),
+                 categories=np.array(tokenizer.categories, dtype=np.int64),
+                 category_names=np.array(category_names, dtype=str))
+
+        if optimizer is not None:
+            torch.save(optimizer.state_dict(), os.path.join(root, 'optimizer.pt'))
+        if graph is not None:
+            np.savez_compressed(os.path.join(root, 'graph.npz'), **graph.to_arrays())
+
+        with open(os.path.join(root, 'config.json'), 'w') as config:
+            json.dump({
+                'version': cls.VERSION,
+                'id_num': model.embs.num_embeddings,
+                'model': {key: getattr(model, key) for key in cls.MODEL_CONFIG},
+                'state': list(state),
+                'optimizer': optimizer is not None,
+                'graph': graph is not None
+            }, config)
+        return cls(root)
+
+    def embeddings(self, mmap=True) -> np.ndarray:
+        ''' center embeddings matrix [token num, embedding size], memory-mapped if `mmap` '''
+        return np.load(os.path.join(self.root, 'model', 'embs.weight.npy'), mmap_mode='r' if mmap else None)
+
+    def vocabulary(self) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        '''
+            `return`: uuid and category id of each token, and category names of ids.
+        '''
+        with np.load(os.path.join(self.root, 'vocabulary.npz')) as arrays:
+            return arrays['uuids'], arrays['categories'], arrays['category_names'].tolist()
+
+    def model(self, device=torch.device('cpu')) -> SimiModel:
+        ''' rebuild SimiModel on device from state dict '''
+        model = SimiModel(self.config['id_num'], {**self.config['model'], 'DEVICE': device})
+        state = {name: torch.from_numpy(np.load(os.path.join(self.root, 'model', f'{name}.npy')))
+                 for name in self.config['state']}
+        model.load_state_dict(state)
+        return model
+
+    def optimizer_state(self) -> Dict:
+        ''' optimizer state dict, None if not saved '''
+        if not self.config['optimizer']:
+            return None
+        return torch.load(os.path.join(self.root, 'optimizer.pt'), map_location=torch.device('cpu'))
+
+    def graph(self, classes: List[type]) -> Graph:
+        '''
+            recover graph snapshot, None if not saved.
+              `classes`: all vertex and edge classes used in graph, such as dataset.CLASSES.
+        '''
+        if not self.config['graph']:
+            return None
+        with np.load(os.path.join(self.root, 'graph.npz')) as arrays:
+            return Graph.from_arrays(arrays, classes)
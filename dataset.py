@@ -2,17 +2,26 @@
     dataset.py
 '''
 from typing import List
+import hashlib
 import json
+import os
+import tempfile
+import zipfile
+import numpy as np
 import pandas as pd
 from utils.graph import Graph, Vertex, Edge
 
 class Instance(Vertex):
     ''' huawei instance vertex define. '''
+    __slots__ = ()
+
     def __init__(self, vid: str):
         Vertex.__init__(self, vid)
 
 class Kpi(Vertex):
     ''' huawei kpi vertex define '''
+    __slots__ = ('classname', 'servicename', 'name')
+
     def __init__(self, vid: str, classname: str, servicename: str, name: str):
         Vertex.__init__(self, vid)
         self.classname = classname
@@ -21,21 +30,33 @@ class Kpi(Vertex):
 
 class Alarm(Vertex):
     ''' huawei alarm vertex define '''
+    __slots__ = ('name',)
+
     def __init__(self, vid: str, name: str):
         Vertex.__init__(self, vid)
         self.name = name
 
 class InstanceToInstance(Edge):
     ''' huawei edge define between instance. '''
+    __slots__ = ('name',)
+
     def __init__(self, name: str):
         Edge.__init__(self, None)
         self.name = name
 
 class KpiAlarmToInstance(Edge):
     ''' huawei edge define between instance and kpi, instance and alarm. '''
+    __slots__ = ()
 
 class KpiAlarmMutualEdge(InstanceToInstance):
     ''' huawei kpi to alarm, vice versa '''
+    __slots__ = ()
+
+# all vertex and edge classes, for recovering graph from snapshot.
+CLASSES = [Instance, Kpi, Alarm, InstanceToInstance, KpiAlarmToInstance, KpiAlarmMutualEdge]
+
+# graph snapshot format version, bump it when graph building or arrays layout changes.
+SNAPSHOT_VERSION = 1
 
 class Dataset:
     '''
@@ -53,79 +74,147 @@ class Dataset:
     def _load_sheet(self, sheet_name: str) -> pd.DataFrame:
         """ read a single sheet from excel file and do some preprocessing """
         # !!! missing values are represented as string 'nan' instead of NaN because of dtype=str
-        data = pd.read_excel(self.root, sheet_name=sheet_name, dtype=str)
+        data = pd.read_excel(self.root, sheet_name=sheet_name, dtype=str).fillna('nan')
         # strip blank character
         for col in data:
-            data[col] = data[col].apply(str.strip)
+            data[col] = data[col].str.strip()
         # drop rows duplicated
         data = data.drop_duplicates()
         data = data.reset_index(drop=True)
         return data
 
+    def _vertex_index(self, *categories: type) -> pd.DataFrame:
+        """ return (vid, category, vi) table of existed vertices, using for join """
+        rows = []
+        for category in categories:
+            prefix = category.__name__ + '|'
+            rows += [(key[len(prefix):], category.__name__, vi)
+                     for key, vi in self.graph.uuids_map.items() if key.startswith(prefix)]
+        return pd.DataFrame(rows, columns=['vid', 'category', 'vi'])
+
+    def _add_vertices(self, category: type, data: pd.DataFrame, key: str, **columns: str) -> np.ndarray:
+        """ add vertex for each distinct key, return vertex indices of all rows """
+        codes, _ = pd.factorize(data[key])
+        firsts = data.drop_duplicates(key)
+        vis = self.graph.add_vertex_columns(category, firsts[key].tolist(), **{
+            name: firsts[column].tolist() for name, column in columns.items()})
+        return vis[codes]
+
+    def _add_mutual_edges(self, heads: np.ndarray, tails: np.ndarray, edges: np.ndarray):
+        """ add edges of both direction, interleaved as inserting row by row """
+        self.graph.add_edges(np.stack([heads, tails], 1).ravel(),
+                             np.stack([tails, heads], 1).ravel(),
+                             np.repeat(edges, 2))
+
+    def _instance_join(self, data: pd.DataFrame) -> pd.DataFrame:
+        """ attach instance vertex index 'vi' to kpi/alarm rows, drop isolate rows """
+        # NOTE: strange vid fetch approach.
+        data = data.assign(vid=data['INSTANCE_NAME'].where(
+            data['INSTANCE_NAME'] != 'nan', data['ENTITY_NAME'].str.split('_').str[0]))
+        data = data.merge(self._vertex_index(Instance)[['vid', 'vi']], on='vid', how='left')
+        # isolate node. skip it.
+        data = data[data['vi'].notna()]
+        return data.astype({'vi': np.int64})
+
     def _load_topo(self):
         # load instance topology to graph.
-        for _, line in self._load_sheet('TOPO').iterrows():
-            vh = Instance(line['首实体(*)'])
-            vt = Instance(line['尾实体(*)'])
-            edge = InstanceToInstance(line['关系名(*)'])
-            self.graph.add_vertex(vh)
-            self.graph.add_vertex(vt)
-            self.graph.add_edge(vh, vt, edge)
-            self.graph.add_edge(vt, vh, edge)
+        data = self._load_sheet('TOPO')
+        # interleave head and tail, keep vertex insert order as row by row.
+        vids = pd.DataFrame({'vid': np.stack([data['首实体(*)'], data['尾实体(*)']], 1).ravel()})
+        vis = self._add_vertices(Instance, vids, 'vid').reshape(-1, 2)
+        edges = self.graph.add_edge_columns(InstanceToInstance, len(data), name=data['关系名(*)'])
+        self._add_mutual_edges(vis[:, 0], vis[:, 1], edges)
 
     def _load_kpi(self):
         # load kpi instance topology to graph.
-        for _, line in self._load_sheet('KPI').iterrows():
-            # NOTE: strange vid fetch approach.
-            vid = line['INSTANCE_NAME'] if line['INSTANCE_NAME'] != 'nan' else line['ENTITY_NAME'].split('_')[0]
-            vh = Kpi(line['Entity ID'], line['Class Name_CN'], line['Service Name_CN'], line['Name_CN'])
-            vt = self.graph.vertex(vid, Instance)
-            # isolate node. skip it.
-            if not vt:
-                continue
-            edge = KpiAlarmToInstance()
-            self.graph.add_vertex(vh)
-            self.graph.add_edge(vh, vt, edge)
-            self.graph.add_edge(vt, vh, edge)
+        data = self._instance_join(self._load_sheet('KPI'))
+        heads = self._add_vertices(Kpi, data, 'Entity ID', classname='Class Name_CN',
+                                   servicename='Service Name_CN', name='Name_CN')
+        edges = self.graph.add_edge_columns(KpiAlarmToInstance, len(data))
+        self._add_mutual_edges(heads, data['vi'].to_numpy(), edges)
 
     def _load_alarm(self):
         # load alarm instance topology to graph.
-        for _, line in self._load_sheet('ALARM').iterrows():
-            # NOTE: strange vid fetch approach.
-            vid = line['INSTANCE_NAME'] if line['INSTANCE_NAME'] != 'nan' else line['ENTITY_NAME'].split('_')[0]
-            vh = Alarm(line['ALARM ID'], line['Name_CN'])
-            vt = self.graph.vertex(vid, Instance)
-            # isolate node. skip it.
-            if not vt:
-                continue
-            edge = KpiAlarmToInstance()
-            self.graph.add_vertex(vh)
-            self.graph.add_edge(vh, vt, edge)
-            self.graph.add_edge(vt, vh, edge)
+        data = self._instance_join(self._load_sheet('ALARM'))
+        heads = self._add_vertices(Alarm, data, 'ALARM ID', name='Name_CN')
+        edges = self.graph.add_edge_columns(KpiAlarmToInstance, len(data))
+        self._add_mutual_edges(heads, data['vi'].to_numpy(), edges)
 
     def _load_rule(self) -> pd.DataFrame:
-        # parse alarm/kpi id and type from a json-formatted string
-        def _parse(s: str) -> pd.Series:
-            jdata = json.loads(s)
-            alarm_id = jdata.get('AlarmID', None)
-            stats_id = jdata.get('StatsID', None)
-            return (alarm_id, 'ALARM') if alarm_id else (stats_id, 'KPI')
+        # parse alarm/kpi id and type from json-formatted strings
+        def _parse(events: pd.Series) -> pd.DataFrame:
+            jdata = pd.DataFrame([json.loads(s) for s in events], columns=['AlarmID', 'StatsID'])
+            is_alarm = jdata['AlarmID'].notna() & (jdata['AlarmID'] != '')
+            return pd.DataFrame({
+                'vid': jdata['AlarmID'].where(is_alarm, jdata['StatsID']),
+                'category': np.where(is_alarm, Alarm.__name__, Kpi.__name__)
+            })
 
         # load alarm instance topology to graph.
-        for _, line in self._load_sheet('RULE').iterrows():
-            hid, htype = _parse(line['事件B'])
-            tid, ttype = _parse(line['事件A'])
-            vh = self.graph.vertex(hid, Kpi if htype == 'KPI' else Alarm)
-            vt = self.graph.vertex(tid, Kpi if ttype == 'KPI' else Alarm)
-            # no such instance
-            if not vt or not vh:
-                continue
-            edge = KpiAlarmMutualEdge(line['关系'])
-            self.graph.add_edge(vh, vt, edge)
-            self.graph.add_edge(vt, vh, edge)
-
-    def build_graph(self, modules: List[str]) -> Graph:
-        ''' convert source data to graph '''
+        data = self._load_sheet('RULE')
+        index = self._vertex_index(Kpi, Alarm)
+        heads = _parse(data['事件B']).merge(index, on=['vid', 'category'], how='left')['vi']
+        tails = _parse(data['事件A']).merge(index, on=['vid', 'category'], how='left')['vi']
+        # no such instance
+        found = (heads.notna() & tails.notna()).to_numpy()
+        edges = self.graph.add_edge_columns(KpiAlarmMutualEdge, int(found.sum()), name=data['关系'][found])
+        self._add_mutual_edges(heads[found].to_numpy(dtype=np.int64),
+                               tails[found].to_numpy(dtype=np.int64), edges)
+
+    def fingerprint(self, modules: List[str]) -> str:
+        '''
+            hash of source file content, modules and snapshot version,
+            graph built by same fingerprint is same.
+        '''
+        sha = hashlib.sha1()
+        with open(self.root, 'rb') as source:
+            for chunk in iter(lambda: source.read(1 << 20), b''):
+                sha.update(chunk)
+        sha.update('|'.join(modules).encode())
+        sha.update(f'|v{SNAPSHOT_VERSION}'.encode())
+        return sha.hexdigest()
+
+    def _snapshot_path(self, modules: List[str]) -> str:
+        """ snapshot file name, keyed by fingerprint """
+        return f'{os.path.splitext(self.root)[0]}.{self.fingerprint(modules)[:16]}.npz'
+
+    def build_graph(self, modules: List[str], snapshot=True) -> Graph:
+        '''
+            convert source data to graph.
+              `snapshot`: load graph from binary snapshot if source data
+              and modules not changed, or write one after building. broken or
+              stale snapshot is ignored and rebuilt.
+        '''
+        path = self._snapshot_path(modules) if snapshot else None
+        if path and os.path.exists(path):
+            graph = self._load_snapshot(path)
+            if graph is not None:
+                self.graph = graph
+                return self.graph
+
         for module in modules:
             getattr(self, f'_load_{module}')()
+        if path:
+            self._save_snapshot(path)
         return self.graph
+
+    def _load_snapshot(self, path: str) -> Graph:
+        """ load graph from snapshot, None if it is broken or of another version """
+        try:
+            with np.load(path) as arrays:
+                if int(arrays['snapshot_version']) != SNAPSHOT_VERSION:
+                    return None
+                return Graph.from_arrays(arrays, CLASSES)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+
+    def _save_snapshot(self, path: str):
+        """ write snapshot to a temp file then move it to path, so readers never see a partial one """
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                np.savez_compressed(out, snapshot_version=np.array(SNAPSHOT_VERSION), **self.graph.to_arrays())
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
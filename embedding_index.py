@@ -0,0 +1,229 @@
+'''
+    embedding_index.py
+'''
+from typing import List, Tuple
+import numpy as np
+from utils.config import Config
+
+class EmbeddingIndex(Config):
+    '''
+        top-k similarity search over token embeddings, such as SimiModel.embs,
+        filterable by token category.
+          `embeddings`: [token num, embedding size] matrix.
+          `categories`: category id of each token, such as Tokenizer.categories.
+    '''
+
+    # similarity, 'dot' as SimiModel scores, or 'cosine'.
+    METRIC = 'dot'
+
+    # queries num scored together by one matmul.
+    BLOCK_SIZE = 1024
+
+    # inverted lists num of approximate index, exact search if 0.
+    LIST_NUM = 0
+
+    # nearest lists num searched for each query.
+    PROBE_NUM = 8
+
+    # kmeans iterations when building inverted lists.
+    KMEANS_ITERATIONS = 10
+
+    # kmeans trains on at most KMEANS_SAMPLE_RATIO points per list.
+    KMEANS_SAMPLE_RATIO = 256
+
+    # embeddings sorted by (category, list), token id of each row, and row of each token id.
+    embeddings: np.ndarray = None
+    order: np.ndarray = None
+    rows: np.ndarray = None
+
+    # rows of category c and list l are [offsets[c * list num + l], offsets[c * list num + l + 1]).
+    offsets: np.ndarray = None
+
+    # inverted lists centroids [list num, embedding size].
+    centroids: np.ndarray = None
+
+    def __init__(self, embeddings: np.ndarray, categories: List[int], conf=None):
+        Config.__init__(self, conf)
+        if self.METRIC not in ('dot', 'cosine'):
+            raise AssertionError(f'unknown metric: {self.METRIC}')
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.categories = np.asarray(categories, dtype=np.int64)
+        if self.METRIC == 'cosine':
+            self.embeddings = _normalize(self.embeddings)
+
+    @staticmethod
+    def from_model(model, tokenizer, conf=None) -> 'EmbeddingIndex':
+        ''' build index of SimiModel center embeddings, tokens are of tokenizer '''
+        return EmbeddingIndex(model.embs.weight.detach().cpu().numpy(), tokenizer.categories, conf).build()
+
+    @staticmethod
+    def from_checkpoint(checkpoint, conf=None) -> 'EmbeddingIndex':
+        ''' build index of embeddings in checkpoint.Checkpoint, loading embeddings and vocabulary only '''
+        return EmbeddingIndex(checkpoint.embeddings(), checkpoint.vocabulary()[1], conf).build()
+
+    def _list_num(self) -> int:
+        return 1 if self.centroids is None else len(self.centroids)
+
+    def build(self, seed=0) -> 'EmbeddingIndex':
+        '''
+            cluster tokens to inverted lists by kmeans if LIST_NUM > 0,
+            then sort embeddings by category and list.
+        '''
+        lists = np.zeros(len(self.embeddings), dtype=np.int64)
+        if self.LIST_NUM:
+            # kmeans on at most KMEANS_SAMPLE_RATIO points per list, empty list keeps its centroid.
+            rng = np.random.default_rng(seed)
+            list_num = min(self.LIST_NUM, len(self.embeddings))
+            sample_num = min(len(self.embeddings), self.KMEANS_SAMPLE_RATIO * list_num)
+            samples = self.embeddings[rng.choice(len(self.embeddings), sample_num, replace=False)]
+            self.centroids = samples[:list_num]
+            for _ in range(0, self.KMEANS_ITERATIONS):
+                lists = self._nearest_lists(samples, 1)[:, 0]
+                order = np.argsort(lists, kind='stable')
+                sizes = np.bincount(lists, minlength=list_num)
+                starts = (np.cumsum(sizes) - sizes)[sizes > 0]
+                self.centroids = self.centroids.copy()
+                self.centroids[sizes > 0] = np.add.reduceat(samples[order], starts) / sizes[sizes > 0, None]
+            lists = self._nearest_lists(self.embeddings, 1)[:, 0]
+
+        keys = self.categories * self._list_num() + lists
+        self.order = np.argsort(keys, kind='stable')
+        self.rows = np.argsort(self.order)
+        self.embeddings = self.embeddings[self.order]
+        self.categories = self.categories[self.order]
+        counts = np.bincount(keys, minlength=(self.categories.max(initial=0) + 1) * self._list_num())
+        self.offsets = np.concatenate([np.zeros(1, np.int64), np.cumsum(counts)])
+        return self
+
+    def _nearest_lists(self, vectors: np.ndarray, num: int) -> np.ndarray:
+        # ids of `num` nearest centroids (l2) of each vector, computed block by block.
+        num = min(num, len(self.centroids))
+        norms = (self.centroids ** 2).sum(-1)
+        res = [np.zeros((0, num), np.int64)]
+        for begin in range(0, len(vectors), self.BLOCK_SIZE):
+            dists = norms - 2 * vectors[begin: begin + self.BLOCK_SIZE] @ self.centroids.T
+            res.append(_top_k(-dists, num)[1])
+        return np.concatenate(res)
+
+    def _ranges(self, categories: List[int], lists: np.ndarray) -> np.ndarray:
+        # rows of given categories (all if None) and lists, as [begin, end) ranges.
+        list_num = self._list_num()
+        if categories is None:
+            categories = range(0, (len(self.offsets) - 1) // list_num)
+        keys = np.array([c * list_num for c in categories if 0 <= c < (len(self.offsets) - 1) // list_num],
+                        dtype=np.int64)
+        keys = (keys[:, None] + lists[None, :]).ravel()
+        return np.stack([self.offsets[keys], self.offsets[keys + 1]], -1)
+
+    def search(self, vectors: np.ndarray, k=10, categories: List[int] = None,
+               exclude: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+            batched top-k search.
+              `vectors`: [query num, embedding size] query vectors.
+              `categories`: only return tokens of these category ids, such as
+              [tokenizer.category_to_id['Alarm']], all if None.
+              `exclude`: token id never returned for each query, -1 for none.
+              `return`: scores and token ids, both [query num, k], sorted by
+              score descending, padded with -inf and -1 if candidates are not enough.
+        '''
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.METRIC == 'cosine':
+            vectors = _normalize(vectors)
+        exclude = np.full(len(vectors), -1) if exclude is None else np.asarray(exclude)
+
+        # one more for excluded token.
+        if self.centroids is None:
+            scores, rows = self._exact(vectors, k + 1, categories)
+        else:
+            scores, rows = self._approximate(vectors, k + 1, categories)
+        ids = np.where(rows >= 0, self.order[rows], -1)
+        scores = np.where((ids == exclude[:, None]) & (ids >= 0), -np.inf, scores)
+        scores, top = _top_k(scores, k)
+        ids = np.take_along_axis(ids, top, -1)
+        return scores, np.where(np.isfinite(scores), ids, -1)
+
+    def query(self, token_ids: List[int], k=10, categories: List[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+            top-k nearest tokens of given tokens, themselves excluded, see search.
+        '''
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        vectors = self.embeddings[self.rows[token_ids]]
+        return self.search(vectors, k, categories, token_ids)
+
+    def _exact(self, vectors: np.ndarray, k: int, categories: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        # score all rows of categories by blocked matmul, category rows are contiguous.
+        ranges = self._ranges(categories, np.zeros(1, np.int64))
+        rows = np.concatenate([np.zeros(0, np.int64)] + [np.arange(begin, end) for begin, end in ranges])
+        embeddings = self.embeddings[ranges[0, 0]: ranges[0, 1]] if len(ranges) == 1 else self.embeddings[rows]
+        res = [_top_k(np.zeros((0, len(rows)), np.float32), k)]
+        for begin in range(0, len(vectors), self.BLOCK_SIZE):
+            res.append(_top_k(vectors[begin: begin + self.BLOCK_SIZE] @ embeddings.T, k))
+        scores, top = np.concatenate([r[0] for r in res]), np.concatenate([r[1] for r in res])
+        return _pad(scores, rows[top], k)
+
+    def _approximate(self, vectors: np.ndarray, k: int, categories: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        # score rows of categories in PROBE_NUM nearest inverted lists of each query.
+        scores = np.full((len(vectors), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(vectors), k), -1, dtype=np.int64)
+        for i, (vector, probe) in enumerate(zip(vectors, self._nearest_lists(vectors, self.PROBE_NUM))):
+            ranges = self._ranges(categories, probe)
+            candidates = np.concatenate([np.zeros(0, np.int64)] + [np.arange(b, e) for b, e in ranges])
+            scores_i, top = _top_k(self.embeddings[candidates] @ vector, k)
+            scores[i, :len(top)] = scores_i
+            rows[i, :len(top)] = candidates[top]
+        return scores, rows
+
+    def save(self, path: str):
+        ''' save built index to a npz file '''
+        arrays = {
+            'metric': np.array(self.METRIC),
+            'block_size': np.array(self.BLOCK_SIZE),
+            'probe_num': np.array(self.PROBE_NUM),
+            'embeddings': self.embeddings,
+            'categories': self.categories,
+            'order': self.order,
+            'offsets': self.offsets,
+        }
+        if self.centroids is not None:
+            arrays.update({'centroids': self.centroids})
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def load(path: str) -> 'EmbeddingIndex':
+        ''' load index saved by save '''
+        with np.load(path) as arrays:
+            # embeddings are sorted and normalized already, assign instead of building.
+            index = EmbeddingIndex(np.zeros((0, 0)), [], {
+                'BLOCK_SIZE': int(arrays['block_size']),
+                'PROBE_NUM': int(arrays['probe_num']),
+            })
+            index.METRIC = str(arrays['metric'])
+            index.embeddings = arrays['embeddings']
+            index.categories = arrays['categories']
+            index.order = arrays['order']
+            index.rows = np.argsort(index.order)
+            index.offsets = arrays['offsets']
+            if 'centroids' in arrays:
+                index.centroids = arrays['centroids']
+                index.LIST_NUM = len(index.centroids)
+        return index
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    # l2 normalize each row.
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # top k (at most) of last dim, sorted descending.
+    k = min(k, scores.shape[-1])
+    if k:
+        top = np.argpartition(-scores, k - 1, -1)[..., :k]
+    else:
+        top = np.zeros((*scores.shape[:-1], 0), np.int64)
+    top_scores = np.take_along_axis(scores, top, -1)
+    order = np.argsort(-top_scores, -1, kind='stable')
+    return np.take_along_axis(top_scores, order, -1), np.take_along_axis(top, order, -1)
+
+def _pad(scores: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # pad to k columns if candidates are not enough.
+    pad = ((0, 0), (0, k - scores.shape[1]))
+    return np.pad(scores, pad, constant_values=-np.inf), np.pad(rows, pad, constant_values=-1)
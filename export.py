@@ -0,0 +1,88 @@
+'''
+    export.py
+'''
+import json
+import os
+from typing import List, Tuple
+import numpy as np
+
+# export format version.
+VERSION = 1
+
+# supported matrix dtypes, int8 is quantized row by row.
+DTYPES = ('float32', 'float16', 'int8')
+
+def export_embeddings(root: str, embeddings: np.ndarray, vids: List[str], categories: List[str],
+                      dtype='float32'):
+    '''
+        export embeddings as binary files which can be memory-mapped without parsing:
+          header.json: version, row num, embedding size and dtype.
+          embeddings.bin: raw [row num, embedding size] matrix in dtype, C order.
+          scales.bin: raw float32 scale of each row, only for int8, row i is
+          embeddings[i] * scales[i].
+          index.tsv: vid and category of each row, tab separated.
+        [PARAMS]
+          `root`: export dir.
+          `embeddings`: [row num, embedding size] matrix.
+          `vids`: vid of each row.
+          `categories`: category name of each row.
+          `dtype`: one of DTYPES.
+    '''
+    if dtype not in DTYPES:
+        raise AssertionError(f'unsupported dtype: {dtype}')
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if not len(vids) == len(categories) == len(embeddings):
+        raise AssertionError('size mismatch between embeddings and index')
+
+    # header is removed first and written last, so an interrupted export over
+    # an old one leaves nothing loadable, instead of old header with new files.
+    os.makedirs(root, exist_ok=True)
+    if os.path.exists(os.path.join(root, 'header.json')):
+        os.remove(os.path.join(root, 'header.json'))
+
+    # symmetric quantization, max abs of each row maps to 127.
+    if dtype == 'int8':
+        scales = np.abs(embeddings).max(-1) / 127
+        scales[scales == 0] = 1
+        np.rint(embeddings / scales[:, None]).astype(np.int8).tofile(os.path.join(root, 'embeddings.bin'))
+        scales.astype(np.float32).tofile(os.path.join(root, 'scales.bin'))
+    else:
+        embeddings.astype(dtype).tofile(os.path.join(root, 'embeddings.bin'))
+
+    with open(os.path.join(root, 'index.tsv'), 'w') as index:
+        index.writelines(f'{vid}\t{category}\n' for vid, category in zip(vids, categories))
+    with open(os.path.join(root, 'header.json'), 'w') as header:
+        json.dump({
+            'version': VERSION,
+            'num': len(embeddings),
+            'size': embeddings.shape[1] if embeddings.ndim == 2 else 0,
+            'dtype': dtype
+        }, header)
+
+def load_embeddings(root: str) -> Tuple[np.ndarray, List[Tuple[str, str]]]:
+    '''
+        load embeddings exported by export_embeddings.
+          `return`: memory-mapped matrix (int8 one is dequantized to float32 in
+          memory), and (vid, category) of each row.
+    '''
+    with open(os.path.join(root, 'header.json')) as header:
+        header = json.load(header)
+    if header['version'] != VERSION:
+        raise AssertionError(f'unsupported export version: {header["version"]}')
+    shape = (header['num'], header['size'])
+    embeddings = np.memmap(os.path.join(root, 'embeddings.bin'), dtype=header['dtype'], mode='r', shape=shape) \
+        if header['num'] else np.zeros(shape, dtype=header['dtype'])
+    if header['dtype'] == 'int8':
+        scales = np.fromfile(os.path.join(root, 'scales.bin'), dtype=np.float32)
+        embeddings = embeddings * scales[:, None]
+    with open(os.path.join(root, 'index.tsv')) as index:
+        rows = [tuple(line.rstrip('\n').split('\t')) for line in index]
+    return embeddings, rows
+
+def export_json(path: str, embeddings: np.ndarray, vids: List[str], categories: List[str]):
+    '''
+        export embeddings as json lines, each line is {id, category, emb} of a row.
+    '''
+    with open(path, 'w') as out:
+        for vid, category, emb in zip(vids, categories, np.asarray(embeddings).tolist()):
+            out.write(json.dumps({'id': vid, 'category': category, 'emb': emb}) + '\n')
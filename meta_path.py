@@ -1,63 +1,100 @@
 '''
     meta_path.py
 '''
+import multiprocessing
 import random
+import tempfile
 import tqdm
-from typing import List, Tuple
-from utils.graph import Vertex, Route, Graph
+from typing import List, Tuple, Iterator
+import numpy as np
+from utils.graph import Route, Graph, CSR
 from utils.config import Config
 
+class MetaPathNode:
+    '''
+        prefix trie node of meta paths, paths share common prefix nodes.
+          `category`: vertex category of this step.
+          `sample_num`: for each head node, how many graph paths we will
+          sample for the meta path ending here, 0 if no path ends here.
+          `children`: next step nodes, keyed by category.
+    '''
+
+    def __init__(self, category: type = None):
+        self.category = category
+        self.sample_num = 0
+        self.children = dict()
+
+    def child(self, category: type) -> 'MetaPathNode':
+        ''' return next step node of category, create if not exists '''
+        return self.children.setdefault(category, MetaPathNode(category))
+
+    def depth(self) -> int:
+        ''' return max path length from this node '''
+        return max([child.depth() + 1 for child in self.children.values()], default=0)
+
 class MetaPath(Config):
     '''
         meta path sampler.
     '''
 
-    # meta paths:
-    meta_paths: List[Tuple[List[type], int]] = None
+    # walkers num advanced together in batch walk.
+    BATCH_SIZE = 65536
+
+    # start vertices num of a parallel walk task, each task has own rng.
+    CHUNK_SIZE = 4096
+
+    # remove route duplicate across whole corpus, not only among routes
+    # of same head vertex and meta path.
+    CORPUS_DEDUP = False
+
+    # meta paths trie, root node has no category.
+    root: MetaPathNode = None
 
     def __init__(self, graph: Graph, conf=None):
-        Config.__init__(conf)
+        Config.__init__(self, conf)
         self.graph = graph
-        self.meta_paths = []
+        self.root = MetaPathNode()
 
-    def _parse_meta_path(self, path: List[type or tuple]) -> List[type]:
-        # parse path
-        if not path:
-            return [[]]
+    def _parse_meta_path(self, nodes: List[MetaPathNode], path: List[type or tuple]) -> List[MetaPathNode]:
+        # extend trie nodes by path step by step, return nodes where path ends.
+        for node in path:
+
+            # parse tuple.
+            if isinstance(node, tuple):
+
+                # for control cmd, such as *0-3 for repeat last node 0-3 times.
+                if isinstance(node[0], str):
+                    cmd = node[0]
+                    if cmd[0] != '*':
+                        raise AssertionError('syntax error')
+                    repeats = range(*map(int, cmd[1:].split('-')))
+                    res = []
+                    for j in range(0, repeats.stop):
+                        if j in repeats:
+                            res += nodes
+                        nodes = [n.child(node[-1]) for n in nodes]
+                    nodes = res
+
+                # for or cmd, all node in tuple will be next node seperately.
+                elif isinstance(node[0], type):
+                    nodes = [n.child(sub_node) for n in nodes for sub_node in node]
 
-        # iteraterly call myself to decode.
-        res = []
-        node = path[0]
-        rcontext_path = self._parse_meta_path(path[1:])
-
-        # parse tuple.
-        if isinstance(node, tuple):
-
-            # for control cmd, such as *0-3 for repeat last node 0-3 times.
-            if isinstance(node[0], str):
-                cmd = node[0]
-                if cmd[0] == '*':
-                    repeat_node = node[-1]
-                    for j in range(*map(int, cmd[1:].split('-'))):
-                        res += [j * [repeat_node] + rp for rp in rcontext_path]
                 else:
                     raise AssertionError('syntax error')
 
-            # for or cmd, all node in tuple will send to path seperately.
-            elif isinstance(node[0], type):
-                for sub_node in node:
-                    res += [[sub_node] + rp for rp in rcontext_path]
+            # normal node.
+            elif isinstance(node, type):
+                nodes = [n.child(node) for n in nodes]
 
-        # normal node.
-        elif isinstance(node, type):
-            res += [[node] + rp for rp in rcontext_path]
+            # unknow cmd.
+            else:
+                raise AssertionError('syntax error')
 
-        # unknow cmd.
-        else:
-            raise AssertionError('syntax error')
+            # same prefix may be reached more than once, merge them.
+            nodes = [*{id(n): n for n in nodes}.values()]
 
         # return parse result.
-        return res
+        return nodes
 
     def add(self, path: List[type or tuple], sample_num=10):
         '''
@@ -65,51 +102,214 @@ class MetaPath(Config):
               `sample_num`: for each head node in this meta path,
               how many graph paths we will sample
         '''
-        for parsed_path in self._parse_meta_path(path):
-            self.meta_paths.append((parsed_path, sample_num))
-
-    def _sample(self, vertex: Vertex, meta_path: List[type]) -> Route:
-        # res path, save edges and vertices.
-        route = Route()
-        route.append(None, vertex)
-        if vertex.category != meta_path[0].__name__:
-            return None
-        # sample next recursively.
-        for category in meta_path[1:]:
-            adjs = [*self.graph.adj(vertex, category)]
-            if not adjs:
-                return None
-            random_adj = random.choice(adjs)
-            route.append(*random_adj)
-            vertex = random_adj[1]
-        return route
-
-    def _remove_route_duplicate(self, routes: List[Route]) -> List[Route]:
-        # no route found. return null.
-        routes = filter(lambda route: route, routes)
-        # not append same route.
-        res = []
-        ruuids = set()
-        for route in routes:
-            uuid = str(route)
-            if uuid in ruuids:
-                continue
-            res.append(route)
-            ruuids.add(uuid)
-        return res
+        for node in self._parse_meta_path([self.root], path):
+            node.sample_num = max(node.sample_num, sample_num)
 
-    def random_walk(self) -> List[Route]:
+    def random_walk(self, seed: int = None, workers: int = 1) -> List[Route]:
         '''
             return random traversal route for each graph node.
+              `seed`: random seed, drawn from python random module if None,
+              so random.seed makes it reproducible too.
+              `workers`: process num, see iter_walks.
         '''
         res: List[Route] = []
-        vertex: Vertex = None
-        # traversal all vertex, sample it.
-        count = sum([path[1] for path in self.meta_paths], 0) * len(self.graph.vertices)
-        with tqdm.trange(0, count) as progress:
-            for vertex in self.graph.vertices:
-                for meta_path, sample_num in self.meta_paths:
-                    ruotes = [self._sample(vertex, meta_path) for _ in range(0, sample_num)]
-                    res += self._remove_route_duplicate(ruotes)
-                    progress.update(sample_num)
+        seed = random.getrandbits(63) if seed is None else seed
+        walks = self.parallel_walk(seed, workers)
+        # edge handle into each vertex, -1 for head vertex and padding.
+        edges = np.full(walks.shape, -1, dtype=np.int64)
+        for j in range(1, walks.shape[1]):
+            edges[:, j] = self.graph.edge_handles(walks[:, j - 1], walks[:, j])
+        for walk, walk_edges in tqdm.tqdm(zip(walks.tolist(), edges.tolist()), total=len(walks)):
+            route = Route(self.graph)
+            for vi, eh in zip(walk, walk_edges):
+                if vi < 0:
+                    break
+                route.append(eh, vi)
+            res.append(route)
         return res
+
+    def _compile(self, node: MetaPathNode = None) -> list:
+        # convert trie to picklable (category id, sample num, subtree max sample num,
+        # children) tuples, drop subtrees without graph category or meta path.
+        res = []
+        for child in (node or self.root).children.values():
+            cid = self.graph.category_ids.get(child.category.__name__)
+            if cid is None:
+                continue
+            children = self._compile(child)
+            max_num = max([child.sample_num] + [c[2] for c in children])
+            if max_num:
+                res.append((cid, child.sample_num, max_num, children))
+        return res
+
+    def signature(self) -> dict:
+        '''
+            json-serializable description of meta paths and configs affecting
+            walks, walks of same graph, signature and seed are same.
+        '''
+        return {'paths': self._compile(), 'batch_size': self.BATCH_SIZE, 'chunk_size': self.CHUNK_SIZE,
+                'corpus_dedup': self.CORPUS_DEDUP}
+
+    def batch_walk(self, starts: np.ndarray = None, rng: np.random.Generator = None) -> np.ndarray:
+        '''
+            vectorized random walk on graph csr, advance a batch of walkers at once.
+            walkers go down meta paths trie, so paths share walks of common prefix.
+              `starts`: start vertex indices, all vertices if None.
+              `rng`: numpy random generator.
+              `return`: int32 walks matrix [walk num, max meta path len], each row
+              is vertex indices of a route, padded with -1.
+        '''
+        csr = self.graph.csr()
+        rng = rng if rng is not None else np.random.default_rng()
+        starts = np.arange(0, len(csr.categories)) if starts is None else np.asarray(starts)
+        walks = _walk(csr, self._compile(), starts, rng, self.root.depth(), self.BATCH_SIZE)
+        return walks[_unique_walks(walks, set())] if self.CORPUS_DEDUP else walks
+
+    def iter_walks(self, seed=0, workers: int = 1, shard: Tuple[int, int] = None) -> Iterator[np.ndarray]:
+        '''
+            lazily generate batch walks chunk by chunk, graph csr is shared by mmap
+            when using process pool. start vertices are split into chunks of
+            CHUNK_SIZE, each chunk has its own rng seeded by (seed, chunk index),
+            so result is same for given seed whatever workers num is.
+              `seed`: random seed.
+              `workers`: process num, cpu count if None, 1 for no process pool.
+              `shard`: (rank, world size), only walk chunks rank, rank + world size, ...
+              so ranks walk disjoint parts of corpus, all chunks if None. chunks
+              are smaller than CHUNK_SIZE if vertices are not enough for all ranks.
+              CORPUS_DEDUP only removes duplicates inside a shard.
+              `return`: walks matrix of each chunk, see batch_walk.
+        '''
+        seen = set() if self.CORPUS_DEDUP else None
+        for walks in self._iter_chunks(seed, workers, shard):
+            yield walks if seen is None else walks[_unique_walks(walks, seen)]
+
+    def _iter_chunks(self, seed: int, workers: int, shard: Tuple[int, int]) -> Iterator[np.ndarray]:
+        # walk for each start vertices chunk of shard, in chunk order.
+        csr = self.graph.csr()
+        paths = self._compile()
+        width = self.root.depth()
+        vertices_num = len(csr.categories)
+        rank, world_size = shard if shard is not None else (0, 1)
+
+        # chunks are shrunk when sharding small graph, so each rank has one at least.
+        chunk_size = max(1, min(self.CHUNK_SIZE, -(-vertices_num // world_size)))
+        chunks = [(seed, i, begin, min(begin + chunk_size, vertices_num))
+                  for i, begin in enumerate(range(0, vertices_num, chunk_size))][rank::world_size]
+
+        # run in current process.
+        if workers == 1:
+            _init_worker(csr, paths, width, self.BATCH_SIZE)
+            for chunk in chunks:
+                yield _walk_chunk(chunk)
+            return
+
+        # share csr by mmap, workers only read it.
+        with tempfile.TemporaryDirectory() as root:
+            csr.save(root)
+            initargs = (root, paths, width, self.BATCH_SIZE)
+            with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+                yield from pool.imap(_walk_chunk, chunks)
+
+    def parallel_walk(self, seed=0, workers: int = None) -> np.ndarray:
+        '''
+            batch walk using a process pool, see iter_walks.
+              `return`: same as batch_walk.
+        '''
+        res = [np.empty((0, self.root.depth()), dtype=np.int32)]
+        return np.concatenate(res + [*self.iter_walks(seed, workers)])
+
+class WalkStream:
+    '''
+        re-iterable lazy walks, generated chunk by chunk by MetaPath.iter_walks.
+        every pass replays same walks because seed is fixed.
+          `transform`: convert each walks chunk, such as encoding to token ids.
+          `shard`: (rank, world size) of walks generated by this stream, see iter_walks.
+    '''
+
+    def __init__(self, meta_path: MetaPath, seed=0, workers: int = 1, transform=None,
+                 shard: Tuple[int, int] = None):
+        self.meta_path = meta_path
+        self.seed = seed
+        self.workers = workers
+        self.transform = transform
+        self.shard = shard
+
+    def __iter__(self):
+        for walks in self.meta_path.iter_walks(self.seed, self.workers, self.shard):
+            yield self.transform(walks) if self.transform else walks
+
+# csr and compiled meta paths used by walk worker.
+_WORKER = dict()
+
+def _init_worker(csr: CSR or str, paths: list, width: int, batch_size: int):
+    # csr object, or dir to load csr from.
+    csr = CSR.load(csr) if isinstance(csr, str) else csr
+    _WORKER.update({'csr': csr, 'paths': paths, 'width': width, 'batch_size': batch_size})
+
+def _walk_chunk(chunk: Tuple[int, int, int, int]) -> np.ndarray:
+    # walk from vertices [begin, end) with a rng owned by this chunk.
+    seed, index, begin, end = chunk
+    rng = np.random.default_rng([seed, index])
+    return _walk(_WORKER['csr'], _WORKER['paths'], np.arange(begin, end),
+                 rng, _WORKER['width'], _WORKER['batch_size'])
+
+def _walk(csr: CSR, paths: list, starts: np.ndarray, rng: np.random.Generator,
+          width: int, batch_size: int) -> np.ndarray:
+    # walk from starts for compiled meta paths trie, return padded walks matrix.
+    res = [np.empty((0, width), dtype=np.int32)]
+    for path in paths:
+        cid, _, max_num, _ = path
+        # skip start vertices which can not match meta path.
+        heads = starts[csr.categories[starts] == cid].astype(np.int32)
+        # split by start vertex, so duplicate routes are in same batch.
+        step = max(batch_size // max_num, 1)
+        for begin in range(0, len(heads), step):
+            batch = heads[begin: begin + step]
+            # replica index of walker for each head vertex.
+            replicas = np.tile(np.arange(0, max_num), len(batch))
+            _advance(csr, path, np.repeat(batch, max_num)[:, None], replicas, rng, width, res)
+    return np.concatenate(res)
+
+def _advance(csr: CSR, path: tuple, walks: np.ndarray, replicas: np.ndarray,
+             rng: np.random.Generator, width: int, res: List[np.ndarray]):
+    # walks matrix, each row is a route reached current trie node.
+    _, sample_num, _, children = path
+
+    # a meta path ends here, remove route duplicate, keep first one.
+    if sample_num:
+        ended = walks[replicas < sample_num]
+        ended = ended[_unique_walks(ended)]
+        res.append(np.pad(ended, ((0, 0), (0, width - ended.shape[1])), constant_values=-1))
+
+    # advance walkers one step for each child, walker without adj will die.
+    for child in children:
+        keep = replicas < child[2]
+        current = walks[keep, -1].astype(np.int64)
+        slot = current * csr.category_num + child[0]
+        begin = csr.indptr[slot]
+        degree = csr.indptr[slot + 1] - begin
+        alive = np.flatnonzero(degree > 0)
+        nexts = csr.indices[begin[alive] + rng.integers(0, degree[alive])]
+        _advance(csr, child, np.column_stack([walks[keep][alive], nexts]),
+                 replicas[keep][alive], rng, width, res)
+
+def _hash_walks(walks: np.ndarray) -> np.ndarray:
+    # 64-bit FNV-1a style hash of each walk row, used as route key.
+    keys = np.full(len(walks), 0xcbf29ce484222325, dtype=np.uint64)
+    for column in walks.astype(np.int64).view(np.uint64).T:
+        keys = (keys ^ column) * np.uint64(0x100000001b3)
+    return keys
+
+def _unique_walks(walks: np.ndarray, seen: set = None) -> np.ndarray:
+    # indices of first occurrence of each distinct walk, in order.
+    # if `seen` is given, walk equal to a seen one is dropped,
+    # and keys of kept walks are added to it.
+    keys = _hash_walks(walks)
+    _, first = np.unique(keys, return_index=True)
+    first = np.sort(first)
+    if seen is None:
+        return first
+    first = np.array([i for i, key in zip(first.tolist(), keys[first].tolist()) if key not in seen],
+                     dtype=np.int64)
+    seen.update(keys[first].tolist())
+    return first
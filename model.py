@@ -18,20 +18,34 @@ class SimiModel(Module, Config):
     # device
     DEVICE = torch.device('cpu')
 
+    # sparse embedding gradient, only rows in batch are touched by optimizer,
+    # use with torch.optim.SparseAdam or utils.optim.RowWiseAdagrad.
+    SPARSE = False
+
+    # separate context embedding table for x2, as input and output vectors
+    # of word2vec. embs is always the center (x1) table.
+    SEPARATE_CONTEXT = False
+
     def __init__(self, id_num: int, conf=None):
         Module.__init__(self)
         Config.__init__(self, conf)
-        self.embs = Embedding(id_num, self.EMBEDDING_SIZE).to(self.DEVICE)
+        self.embs = Embedding(id_num, self.EMBEDDING_SIZE, sparse=self.SPARSE).to(self.DEVICE)
+        self.context_embs = None
+        if self.SEPARATE_CONTEXT:
+            self.context_embs = Embedding(id_num, self.EMBEDDING_SIZE, sparse=self.SPARSE).to(self.DEVICE)
+            torch.nn.init.zeros_(self.context_embs.weight)
 
     # pylint: disable=arguments-differ
     def forward(self, x1: torch.LongTensor, x2: torch.LongTensor):
         '''
             calc similarity.
               x1 shape: [*], * for any.
-              x2 shape: [*], * for any.
+              x2 shape: [*] for pairs, or [*, K] for K contexts (such as a
+              positive and its negatives) of each center, center is gathered once.
         '''
-        saved_size = x1.size()
-        # x1, x2 shape: [*, hidden_size]
-        x1 = self.embs(x1.view(-1))
-        x2 = self.embs(x2.view(-1))
-        return (x1 * x2).sum(-1).view(saved_size)
+        # x1 shape: [*, hidden_size], x2 shape: [*, hidden_size] or [*, K, hidden_size]
+        x1 = self.embs(x1)
+        x2 = (self.embs if self.context_embs is None else self.context_embs)(x2)
+        if x2.dim() > x1.dim():
+            return torch.einsum('...h,...kh->...k', x1, x2)
+        return (x1 * x2).sum(-1)
@@ -1,10 +1,11 @@
 '''
     skip_gram.py
 '''
-from typing import List, Dict
-import random
+from typing import List, Dict, Iterable, Iterator
+import numpy as np
 import torch
 from utils.config import Config
+from utils.example_store import ExampleStore
 
 class Token():
     '''
@@ -18,7 +19,14 @@ class Token():
 class SkipGramWithType(Config):
     '''
         skip gram with type implementation.
-          `corpus`: a list of context which consisted of token sequences.
+          `corpus`: contexts chunks, each is a token ids matrix padded with -1,
+          such as walks encoded by Tokenizer.encode_walks. iterated twice
+          (statistic and example generation), so lazy re-iterable corpus such
+          as meta_path.WalkStream keeps memory bounded.
+          `categories`: category id of each token, such as Tokenizer.categories.
+          `counts`: repeat num of each token in whole corpus, counted from corpus
+          if None. given when corpus is a shard of whole one, such as sum of
+          count_tokens of all shards, so all shards share same neg token tables.
     '''
 
     # skip gram half window size
@@ -27,92 +35,233 @@ class SkipGramWithType(Config):
     # negative sample num
     NEGATIVE_SAMPLE_NUM = 5
 
-    # table size, suitable for 10 times vocabulary size.
+    # min table size of each category.
     TABLE_SIZE = 5000
 
-    # neg token size: [category_num, table_size]
-    neg_tokens: List[List[int]] = None
-    corpus: List[List[Token]] = None
+    # table size is TABLE_RATIO times vocabulary size of category at least.
+    TABLE_RATIO = 10
 
-    def __init__(self, corpus: List[List[Token]], category_num: int, conf=None):
+    # frequent token subsampling threshold t, token with frequency f is kept
+    # with probability (sqrt(f / t) + 1) * t / f, no subsampling if None.
+    SUBSAMPLE_THRESHOLD = None
+
+    # shrink half window of each center token to random size in [1, HALF_WINDOW_SIZE].
+    DYNAMIC_WINDOW = False
+
+    # seed of subsampling and negative sampling rng, random if None.
+    SEED = None
+
+    # neg token tables: [category_num, table_size of category]
+    neg_tokens: List[np.ndarray] = None
+    corpus: Iterable[np.ndarray] = None
+
+    def __init__(self, corpus: Iterable[np.ndarray], categories: List[int], conf=None, counts: np.ndarray = None):
         Config.__init__(self, conf)
         self.corpus = corpus
-        self.neg_tokens = []
-
-        # statistical info initial.
-        total_token_nums = category_num * [0]
-        token_nums = []
-        token_weights = []
-        for i in range(0, category_num):
-            token_nums.append(dict())
-            token_weights.append([])
-            self.neg_tokens.append(self.TABLE_SIZE * [0])
-
-        # record token repeat num
+        self.categories = np.asarray(categories, dtype=np.int64)
+        self.rng = np.random.default_rng(self.SEED)
+
+        # record token repeat num.
+        counts = self.count_tokens(corpus, len(self.categories)) if counts is None else np.asarray(counts)
+        self.neg_tokens = self._build_tables(counts)
+        self.keep_probs = self._keep_probs(counts)
+
+        # all tables in one array, table of category i is at [offsets[i], offsets[i] + sizes[i]).
+        self.table_sizes = np.array([len(table) for table in self.neg_tokens], dtype=np.int64)
+        self.table_offsets = np.cumsum(self.table_sizes) - self.table_sizes
+        self.neg_table = np.concatenate([np.zeros(0, dtype=np.int32)] + self.neg_tokens)
+
+    @classmethod
+    def signature(cls, conf: dict = None) -> dict:
+        '''
+            effective config of skip gram built with `conf`, class defaults
+            included, json-serializable description of how examples are generated.
+        '''
+        res = {key: getattr(cls, key) for key in dir(cls) if key.isupper()}
+        res.update(conf or dict())
+        return res
+
+    @staticmethod
+    def count_tokens(corpus: Iterable[np.ndarray], token_num: int) -> np.ndarray:
+        ''' repeat num of each token id in corpus, int64 [token_num] '''
+        counts = np.zeros(token_num, dtype=np.int64)
         for context in corpus:
-            for token in context:
-                token_num = token_nums[token.category_id]
-                token_num.setdefault(token.token_id, 0)
-                token_num[token.token_id] += 1
-                total_token_nums[token.category_id] += 1
-
-        # normalize.
-        total_token_nums = [num ** 0.75 for num in total_token_nums]
-        for i, token_num in enumerate(token_nums):
-            # skip-gram divide point.
-            segment = 0
-            for token_id, num in token_num.items():
-                segment += (num ** 0.75) / total_token_nums[i]
-                token_weights[i].append((token_id, segment))
-
-        # generate neg table.
-        for token_weight, neg_token in zip(token_weights, self.neg_tokens):
-            step = token_weight[-1][1] / self.TABLE_SIZE
-            weight_index = 0
-            for j in range(0, self.TABLE_SIZE):
-                cur_weight = step * j
-                # push weight_index if its weight fall behind.
-                while token_weight[weight_index][1] < cur_weight:
-                    weight_index += 1
-                # save cur neg token_id
-                neg_token[j] = token_weight[weight_index][0]
-
-    def _neg_sample(self, token: Token, exclude: List[Token]) -> List[int]:
-        ''' sample negative for token, excluded tokens will not be sampled. '''
-        exclude_token_ids = [t.token_id for t in exclude]
-        neg_token_ids = []
-
-        # remove excluded tokens.
-        for nt in random.sample(self.neg_tokens[token.category_id], self.NEGATIVE_SAMPLE_NUM):
-            if not nt in exclude_token_ids:
-                neg_token_ids.append(nt)
-
-        # len is self.NEGATIVE_SAMPLE_NUM for most most most situation.
-        return neg_token_ids
+            context = np.asarray(context)
+            counts += np.bincount(context[context >= 0], minlength=token_num)
+        return counts
+
+    def _build_tables(self, counts: np.ndarray) -> List[np.ndarray]:
+        # token i covers (cum[i - 1], cum[i]] of table, weight is num ** 0.75.
+        tables = []
+        weights = counts ** 0.75
+        for cid in range(0, int(self.categories.max(initial=-1)) + 1):
+            ids = np.flatnonzero((self.categories == cid) & (counts > 0))
+            if not len(ids):
+                tables.append(np.zeros(0, dtype=np.int32))
+                continue
+            cum = np.cumsum(weights[ids])
+            size = max(self.TABLE_SIZE, self.TABLE_RATIO * len(ids))
+            index = np.searchsorted(cum, cum[-1] * np.arange(0, size) / size)
+            tables.append(ids[index].astype(np.int32))
+        return tables
+
+    def _keep_probs(self, counts: np.ndarray) -> np.ndarray:
+        # keep probability of each token when subsampling frequent tokens.
+        if self.SUBSAMPLE_THRESHOLD is None:
+            return None
+        freqs = counts / max(counts.sum(), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probs = (np.sqrt(freqs / self.SUBSAMPLE_THRESHOLD) + 1) * self.SUBSAMPLE_THRESHOLD / freqs
+        return np.nan_to_num(probs, nan=1.0, posinf=1.0)
+
+    def _subsample(self, context: np.ndarray) -> np.ndarray:
+        # drop frequent tokens randomly, then shift kept tokens to head of each row.
+        valid = context >= 0
+        drop = valid & (self.rng.random(context.shape) >= self.keep_probs[np.where(valid, context, 0)])
+        context = np.where(drop, -1, context)
+        order = np.argsort(context < 0, axis=1, kind='stable')
+        return np.take_along_axis(context, order, 1)
+
+    def _neg_sample(self, tokens: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        '''
+            sample negatives for each token from table of its category.
+              `tokens`: token ids, never sampled as their own negative.
+              `centers`: center token ids, never sampled as negative either.
+              `return`: [len(tokens), NEGATIVE_SAMPLE_NUM] negative token ids,
+              -1 for excluded ones.
+        '''
+        cids = self.categories[tokens]
+        shape = (len(tokens), self.NEGATIVE_SAMPLE_NUM)
+        index = self.table_offsets[cids, None] + self.rng.integers(0, self.table_sizes[cids, None], shape)
+        negs = self.neg_table[index]
+        return np.where((negs == tokens[:, None]) | (negs == centers[:, None]), -1, negs)
+
+    def _context_pairs(self, context: np.ndarray) -> tuple:
+        # subsampled tokens are removed before windowing, as if never appeared.
+        if self.keep_probs is not None:
+            context = self._subsample(context)
+
+        # window of token i is context[i - H: i + H], as strided view of padded context.
+        half = self.HALF_WINDOW_SIZE
+        padded = np.pad(context.astype(np.int64), ((0, 0), (half, half)), constant_values=-1)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * half, axis=1)[:, :context.shape[1]]
+        centers = np.broadcast_to(context[:, :, None], windows.shape)
+
+        # positive pairs, skip padding and myself.
+        keep = (centers >= 0) & (windows >= 0) & (windows != centers)
+
+        # window of token i shrinks to context[i - h: i + h], h is random in [1, H].
+        if self.DYNAMIC_WINDOW:
+            halves = self.rng.integers(1, half + 1, (*context.shape, 1))
+            offsets = np.arange(-half, half)
+            keep &= (offsets >= -halves) & (offsets < halves)
+        return centers[keep], windows[keep]
+
+    def _context_examples(self, context: np.ndarray) -> tuple:
+        # each positive example followed by its negatives, drop excluded negatives.
+        centers, tokens = self._context_pairs(context)
+        x2 = np.column_stack([tokens, self._neg_sample(tokens, centers)])
+        y = np.broadcast_to(np.array([1] + [-1] * self.NEGATIVE_SAMPLE_NUM), x2.shape)
+        keep = x2 >= 0
+        return np.broadcast_to(centers[:, None], x2.shape)[keep], x2[keep], y[keep]
+
+    def iter_examples(self) -> Iterator[Dict[str, np.ndarray]]:
+        '''
+            lazily generate examples of each corpus chunk, see generate_examples.
+              `return`: array dict of x1, x2 and y.
+        '''
+        for context in self.corpus:
+            x1, x2, y = self._context_examples(np.asarray(context))
+            yield {'x1': x1, 'x2': x2, 'y': y}
+
+    def iter_positives(self) -> Iterator[Dict[str, np.ndarray]]:
+        '''
+            lazily generate positives of each corpus chunk, see generate_positives.
+              `return`: array dict of x1, x2 and category.
+        '''
+        for context in self.corpus:
+            x1, x2 = self._context_pairs(np.asarray(context))
+            yield {'x1': x1, 'x2': x2, 'category': self.categories[x2]}
 
     def generate_examples(self) -> Dict[str, torch.LongTensor]:
         '''
             using skip gram with type to convert corpus to
             2-classification tensor dict, using Negative Sampling.
         '''
-        examples = []
-        for context in self.corpus:
-            for i, token in enumerate(context):
-                window = context[max(i - self.HALF_WINDOW_SIZE, 0): i + self.HALF_WINDOW_SIZE]
-                for ctoken in window:
-                    # skip myself
-                    if ctoken.token_id == token.token_id:
-                        continue
+        return _concat_chunks(self.iter_examples(), ['x1', 'x2', 'y'])
+
+    def generate_positives(self) -> Dict[str, torch.LongTensor]:
+        '''
+            convert corpus to positive (center, context) pairs only,
+            negatives are drawn for each batch by NegativeSampler.
+              `return`: tensor dict of x1 (center), x2 (context) and
+              category (category id of context).
+        '''
+        return _concat_chunks(self.iter_positives(), ['x1', 'x2', 'category'])
 
-                    # append this positive example.
-                    examples.append((token.token_id, ctoken.token_id, 1))
+    def negative_tables(self) -> Dict[str, np.ndarray]:
+        ''' all neg token tables in one array, with offset and size of each category's table '''
+        return {'neg_table': self.neg_table, 'table_offsets': self.table_offsets, 'table_sizes': self.table_sizes}
 
-                    # sample negative, exclude current token and center token.
-                    for neg_token_id in self._neg_sample(ctoken, [ctoken, token]):
-                        examples.append((token.token_id, neg_token_id, -1))
+    def negative_sampler(self, device=torch.device('cpu')) -> 'NegativeSampler':
+        ''' NegativeSampler using neg token tables of this skip gram '''
+        return NegativeSampler(self.negative_tables(), self.NEGATIVE_SAMPLE_NUM, device)
 
+    def save_examples(self, root: str, positives=False, key: dict = None) -> ExampleStore:
+        '''
+            write examples (or positives only) to an on-disk store chunk by chunk,
+            token ids as int32, labels as int8 and categories as int16.
+            neg token tables are saved along with them, see negative_tables.
+              `root`: store dir.
+              `key`: description of corpus source, see ExampleStore.write.
+        '''
+        if positives:
+            chunks, dtypes = self.iter_positives(), {'x1': np.int32, 'x2': np.int32, 'category': np.int16}
+        else:
+            chunks, dtypes = self.iter_examples(), {'x1': np.int32, 'x2': np.int32, 'y': np.int8}
+        return ExampleStore.write(root, chunks, dtypes, key, self.negative_tables())
+
+def _concat_chunks(chunks: Iterable[Dict[str, np.ndarray]], keys: List[str]) -> Dict[str, torch.LongTensor]:
+    # concat array dict chunks to long tensor dict.
+    res = {key: [np.empty(0, np.int64)] for key in keys}
+    for chunk in chunks:
+        for key in keys:
+            res[key].append(chunk[key])
+    return {key: torch.from_numpy(np.concatenate(arrays).astype(np.int64)) for key, arrays in res.items()}
+
+class NegativeSampler():
+    '''
+        draw negatives on device for each batch of positive pairs,
+        so every round sees new negatives.
+          `tables`: neg token tables, see SkipGramWithType.negative_tables, or
+          ExampleStore.extras of a store written by SkipGramWithType.save_examples.
+          `negative_sample_num`: negatives num of each positive.
+          `device`: device where tables live and negatives are drawn.
+    '''
+
+    def __init__(self, tables: Dict[str, np.ndarray], negative_sample_num: int, device=torch.device('cpu')):
+        self.negative_sample_num = negative_sample_num
+        self.table = torch.from_numpy(tables['neg_table'].astype(np.int64)).to(device)
+        self.offsets = torch.from_numpy(tables['table_offsets'].astype(np.int64)).to(device)
+        self.sizes = torch.from_numpy(tables['table_sizes'].astype(np.int64)).to(device)
+
+    def __call__(self, batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        '''
+            expand positives batch to examples.
+              `batch`: x1, x2 and category tensors of shape [B].
+              `return`: x1 (center) of shape [B], x2 and y of shape
+              [B, 1 + NEGATIVE_SAMPLE_NUM], column 0 is positive example (y = 1),
+              others negative (y = -1), y = 0 for negative colliding with center
+              or context token.
+        '''
+        x1, x2, category = batch['x1'][:, None], batch['x2'][:, None], batch['category'][:, None].long()
+        shape = (x2.shape[0], self.negative_sample_num)
+        rand = torch.rand(shape, dtype=torch.float64, device=x2.device)
+        index = self.offsets[category] + (rand * self.sizes[category]).long()
+        negs = self.table[index]
+        y = torch.full(shape, -1, dtype=torch.long, device=x2.device).masked_fill((negs == x1) | (negs == x2), 0)
         return {
-            'x1': torch.LongTensor([x[0] for x in examples]),
-            'x2': torch.LongTensor([x[1] for x in examples]),
-            'y': torch.LongTensor([x[2] for x in examples]),
+            'x1': batch['x1'],
+            'x2': torch.cat([x2, negs], -1),
+            'y': torch.cat([torch.ones_like(x2), y], -1),
         }
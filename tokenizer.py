@@ -2,43 +2,61 @@
     tokenizer.py
 '''
 from typing import List
-from utils.graph import Vertex, Route
+import numpy as np
+from utils.graph import Vertex, Records, Route
 from skip_gram import Token
 
 class Tokenizer():
     '''
         convert a group of graph route to id sequences.
         so make all routes like text.
-          `vertices`: work like words. be used to build vocabulary
+          `vertices`: work like words. be used to build vocabulary, graph.vertices
+          records are read by uuid and category columns without creating vertex
+          objects, a list of vertex objects works too.
     '''
 
     vertices_num = 0
     category_num = 0
 
-    def __init__(self, vertices: List[Vertex]):
+    def __init__(self, vertices: Records or List[Vertex]):
         # initialize
         self.uuid_to_id = dict()
         self.category_to_id = dict()
-        self.vocabulary: List[Vertex] = []
+        self.vertices = vertices
+        # uuid, category id, and handle in vertices of each token.
+        self.uuids: List[str] = []
+        self.categories: List[int] = []
+        self.handles: List[int] = []
+        # token id of each vertex used to build vocabulary, in order.
+        self.vertex_token_ids: List[int] = []
 
-        # build vocabulary for encode and decode.
-        for v in vertices:
-            vid = self.uuid_to_id.get(v.uuid)
-            cid = self.category_to_id.get(v.category)
+        if isinstance(vertices, Records):
+            names = [cls.__name__ for cls in vertices.classes]
+            columns = zip(vertices.uuids, (names[cid] for cid in vertices.categories))
+        else:
+            columns = ((v.uuid, v.category) for v in vertices)
 
-            # new vertex(or called word)
-            if vid is None:
-                vid = self.vertices_num
-                self.uuid_to_id.update({v.uuid:vid})
-                self.vocabulary.append(v)
-                self.vertices_num += 1
+        # build vocabulary for encode and decode.
+        for handle, (uuid, category) in enumerate(columns):
+            vid = self.uuid_to_id.get(uuid)
+            cid = self.category_to_id.get(category)
 
             # new category
             if cid is None:
                 cid = self.category_num
-                self.category_to_id.update({v.category:cid})
+                self.category_to_id.update({category:cid})
                 self.category_num += 1
 
+            # new vertex(or called word)
+            if vid is None:
+                vid = self.vertices_num
+                self.uuid_to_id.update({uuid:vid})
+                self.uuids.append(uuid)
+                self.categories.append(cid)
+                self.handles.append(handle)
+                self.vertices_num += 1
+            self.vertex_token_ids.append(vid)
+
     def encode(self, routes: Route) -> List[Token]:
         '''
             tokenizer an route, re-index vertex to 0 ~ N,
@@ -54,15 +72,26 @@ class Tokenizer():
             path.append(Token(vid, cid))
         return path
 
+    def encode_walks(self, walks: np.ndarray) -> np.ndarray:
+        '''
+            tokenizer batch walks returned by MetaPath.batch_walk.
+              `walks`: vertex indices matrix padded with -1, vertices are
+              graph vertices which used to build this tokenizer.
+              `return`: token ids matrix padded with -1, category id of
+              token is self.categories[token id].
+        '''
+        token_ids = np.asarray(self.vertex_token_ids, dtype=np.int64)
+        return np.where(walks >= 0, token_ids[np.maximum(walks, 0)], -1)
+
     def decode(self, token_ids: List[int]) -> List[Vertex]:
         '''
             de-tokenizer an token sequences.
               `token_ids`: token id sequences.
-              `return`: a graph vertex list.
+              `return`: a graph vertex list, created from vertices on demand.
         '''
         vertices = []
         for token_id in token_ids:
-            vertex = self.vocabulary[token_id]
+            vertex = self.vertices[self.handles[token_id]]
             vertices.append(vertex)
         return vertices
 
@@ -1,73 +1,194 @@
 '''
     trainer.py
 '''
+import os
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from pytorch_transformers import AdamW
+from checkpoint import Checkpoint
 from dataset import Dataset, Instance, Kpi, Alarm
-from meta_path import MetaPath
+from meta_path import MetaPath, WalkStream
 from model import SimiModel
-from skip_gram import SkipGramWithType
+from skip_gram import SkipGramWithType, NegativeSampler
 from tokenizer import Tokenizer
 from utils.dataloader import DictDataLoader
+from utils.example_store import ExampleStore
+from utils.optim import RowWiseAdagrad
 from utils import deep_apply_dict
 
+def _step(model: SimiModel, optimizer, sampler: NegativeSampler, batch: dict) -> torch.Tensor:
+    # train one batch, return loss.
+    # in fact, y is 1 or -1, and 0 for negatives dropped by sampler.
+    model.train()
+    device = next(model.parameters()).device
+    deep_apply_dict(batch, lambda _, v: v.to(device, torch.long))
+    batch = sampler(batch) if sampler else batch
+    y = batch.pop('y')
+    res = model.forward(**batch)
+    loss = -torch.log(torch.sigmoid((y * res)))[y != 0].mean(-1)
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad()
+    return loss
+
+def _shard(tensors: dict, rank: int, world_size: int) -> dict:
+    # contiguous shard of rank, all shards have same size.
+    num = len(next(iter(tensors.values()))) // world_size
+    return {key: val[rank * num: (rank + 1) * num] for key, val in tensors.items()}
+
+def _hogwild_worker(rank: int, model: SimiModel, optimizer, tensors: dict or ExampleStore,
+                    sampler: NegativeSampler, workers: int, rounds: int, batch_size: int):
+    # train on shard of examples, update shared model without lock.
+    torch.set_num_threads(1)
+    torch.manual_seed(rank)
+    tensors = tensors.tensors() if isinstance(tensors, ExampleStore) else tensors
+    shard = _shard(tensors, rank, workers)
+    dataloader = DictDataLoader(shard, {'batch_size': batch_size, 'shuffle': True})
+    for round_num in range(0, rounds):
+        for step, batch in enumerate(dataloader):
+            loss = _step(model, optimizer, sampler, batch)
+            if rank == 0:
+                print(f'[round: {round_num}]: {step}/{len(dataloader)} end. loss: {loss}')
+
+def train_hogwild(model: SimiModel, optimizer: RowWiseAdagrad, tensors: dict or ExampleStore,
+                  sampler: NegativeSampler = None, workers: int = None, rounds=200, batch_size=20000):
+    '''
+        hogwild style training on cpu, processes share model and optimizer
+        state by shared memory, and apply sparse updates asynchronously.
+          `tensors`: train tensors, or example store mapped by each process,
+          sharded by process.
+          `workers`: process num, cpu count if None.
+    '''
+    workers = workers or mp.cpu_count()
+    model.share_memory()
+    optimizer.share_memory()
+    mp.spawn(_hogwild_worker, args=(model, optimizer, tensors, sampler, workers, rounds, batch_size),
+             nprocs=workers)
+
+def train_distributed(model: SimiModel, optimizer, tensors: dict,
+                      sampler: NegativeSampler = None, rounds=200, batch_size=20000):
+    '''
+        data parallel training on cpu by torch.distributed gloo backend, called in each
+        process launched by torchrun or alike after dist.init_process_group.
+        gradients are averaged across processes.
+          `tensors`: train tensors of this rank, such as examples of its walks shard.
+    '''
+    rank = dist.get_rank()
+
+    # all ranks take same num of samples each round, so same num of steps. a rank
+    # with fewer examples takes all of them and random repeated ones, none is dropped.
+    num = torch.tensor(len(next(iter(tensors.values()))))
+    dist.all_reduce(num, dist.ReduceOp.MAX)
+    dataloader = DictDataLoader(tensors, {'batch_size': batch_size, 'shuffle': True, 'num_samples': int(num)})
+    ddp_model = DistributedDataParallel(model)
+    for round_num in range(0, rounds):
+        for step, batch in enumerate(dataloader):
+            loss = _step(ddp_model, optimizer, sampler, batch)
+            if rank == 0:
+                print(f'[round: {round_num}]: {step}/{len(dataloader)} end. loss: {loss}')
+
 def main():
     ''' main '''
     # build graph
-    graph = Dataset('先验知识表_v0.2.xlsx').build_graph(['topo', 'alarm', 'kpi'])
+    dataset, modules = Dataset('先验知识表_v0.2.xlsx'), ['topo', 'alarm', 'kpi']
+    graph = dataset.build_graph(modules)
 
     # pre-define meta path
     meta_path = MetaPath(graph)
     meta_path.add([(Alarm, Kpi), ('*1-3', Instance), (Kpi, Alarm)], 20)
 
-    # generate route using random walk
-    routes = meta_path.random_walk()
+    # train across processes if launched by torchrun, or on gpu if any, or hogwild on all cpu cores.
+    # each process walks its own shard of corpus.
+    distributed = 'WORLD_SIZE' in os.environ
+    if distributed:
+        dist.init_process_group('gloo')
+    shard = (dist.get_rank(), dist.get_world_size()) if distributed else None
 
-    # build vocabulary, encode route.
+    # build vocabulary, generate and encode route lazily using random walk.
     tokenizer = Tokenizer(graph.vertices)
-    corpus = [tokenizer.encode(route) for route in routes]
+    corpus = WalkStream(meta_path, seed=0, transform=tokenizer.encode_walks, shard=shard)
+
+    # draw new negatives for each batch on device, instead of fixing them before training.
+    online_negative = True
 
-    # generating examples using skip gram with type.
-    train_tensors = SkipGramWithType(corpus, tokenizer.category_size(), {
+    # skip gram with type config.
+    skip_gram_conf = {
         'HALF_WINDOW_SIZE': 3,
         'NEGATIVE_SAMPLE_NUM': 5,
         'TABLE_SIZE': 5000
-    }).generate_examples()
+    }
+
+    # examples and neg token tables are generated once and saved on disk, reused by
+    # next run with same graph, meta path, walk seed and effective skip gram config.
+    root = './positives' if online_negative else './examples'
+    root += f'.{shard[0]}' if distributed else ''
+    key = {
+        'graph': dataset.fingerprint(modules),
+        'meta_path': meta_path.signature(),
+        'seed': corpus.seed,
+        'shard': shard,
+        'skip_gram': SkipGramWithType.signature(skip_gram_conf),
+        'vocabulary_size': tokenizer.vocabulary_size(),
+        'positives': online_negative
+    }
+    reuse = ExampleStore.exists(root, key)
+    if distributed:
+        # token counts are summed across ranks, so all ranks reuse stores or none does.
+        reuse = torch.tensor(int(reuse))
+        dist.all_reduce(reuse, dist.ReduceOp.MIN)
+        reuse = bool(reuse)
+    if reuse:
+        store = ExampleStore(root)
+    else:
+        # counting tokens walks corpus, only done when store is missing or stale.
+        counts = None
+        if distributed:
+            counts = torch.from_numpy(SkipGramWithType.count_tokens(corpus, tokenizer.vocabulary_size()))
+            dist.all_reduce(counts)
+            counts = counts.numpy()
+        skip_gram = SkipGramWithType(corpus, tokenizer.categories, skip_gram_conf, counts)
+        store = skip_gram.save_examples(root, positives=online_negative, key=key)
+    train_tensors = store.tensors()
 
     # create model.
     model = SimiModel(tokenizer.vocabulary_size(), {
         'EMBEDDING_SIZE': 128,
-        'DEVICE': torch.device('cuda:0')
+        'DEVICE': torch.device('cuda:0' if torch.cuda.is_available() and not distributed else 'cpu'),
+        'SPARSE': True
     })
 
-    deep_apply_dict(train_tensors, lambda _, v: v.to(model.DEVICE))
+    sampler = NegativeSampler(store.extras(), skip_gram_conf['NEGATIVE_SAMPLE_NUM'], model.DEVICE) \
+        if online_negative else None
 
-    # create dataloader.
+    # create dataloader, batches are moved to device one by one.
     dataloader = DictDataLoader(train_tensors, {
         'batch_size': 20000
     })
 
-    # optimizer
-    optimizer = AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-3)
+    # optimizer, sparse one only updates embedding rows in batch.
+    if model.SPARSE:
+        optimizer = RowWiseAdagrad([p for p in model.parameters() if p.requires_grad], lr=1e-1)
+    else:
+        optimizer = AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-3)
 
     # train start.
-    for round_num in range(0, 200):
-        for step, batch in enumerate(dataloader):
-            # in fact, y is 1 or -1
-            model.train()
-            y = batch.pop('y')
-            res = model.forward(**batch)
-            loss = -torch.log(torch.sigmoid((y * res))).mean(-1)
-            print(f'[round: {round_num}]: {step}/{len(dataloader)} end. loss: {loss}')
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
-
-    torch.save({
-        'model': model,
-        'tokenizer': tokenizer,
-        'graph': graph
-    }, './saved2.bin')
+    if distributed:
+        train_distributed(model, optimizer, train_tensors, sampler, rounds=200, batch_size=20000)
+    elif model.DEVICE.type == 'cpu' and model.SPARSE:
+        train_hogwild(model, optimizer, store, sampler, rounds=200, batch_size=20000)
+    else:
+        for round_num in range(0, 200):
+            for step, batch in enumerate(dataloader):
+                loss = _step(model, optimizer, sampler, batch)
+                print(f'[round: {round_num}]: {step}/{len(dataloader)} end. loss: {loss}')
+
+    # every rank has same model after distributed training.
+    if not distributed or shard[0] == 0:
+        Checkpoint.save('./checkpoint', model, tokenizer, optimizer, graph)
+    if distributed:
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     main()
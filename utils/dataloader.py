@@ -1,42 +1,63 @@
 '''
     task loader.
-    encapsulation of DataLoader and TensorDataset by adding keys.
+    batch iteration over a dict of tensors by slicing them directly.
 '''
 
 from typing import Dict, List
 import torch
-from torch.utils.data.dataset import TensorDataset
-from torch.utils.data.dataloader import DataLoader
 import utils
 
 class DictDataLoader():
     '''
         [DESCRIPTION]
           because TensorDataset lacks key index function.
-          we create this class.
+          we create this class. batches are sliced from whole tensors instead of
+          collated sample by sample: contiguous views without shuffle, or index_select
+          of a permutation generated once per epoch with shuffle.
         [PARAMS]
           `tensors_dict`: a group of tensors with key. first dim of tensor must same(for sampling).
-          `dl_config`: dataloader config, see Dataloader for detail.
+          `dl_config`: dataloader config, supports batch_size, shuffle and drop_last,
+          see Dataloader for detail. and num_samples, samples num of each epoch, if it
+          is larger than tensors size, all samples are fetched and the rest are random
+          repeated ones, drawn again each epoch.
     '''
 
     # tensors key list
     key_list: List = None
 
-    # dataloader
-    dataloader = None
+    # tensors of key list.
+    tensors_list: List[torch.Tensor] = None
+
+    # supported dataloader config and default value.
+    CONFIG = {'batch_size': 1, 'shuffle': False, 'drop_last': False, 'num_samples': None}
 
     def __init__(self, tensors_dict: Dict[str, torch.Tensor], dl_config: dict()):
+        unknown = set(dl_config) - set(self.CONFIG)
+        if unknown:
+            raise AssertionError(f'unsupported dataloader config: {unknown}')
+        config = {**self.CONFIG, **dl_config}
+        self.batch_size = config['batch_size']
+        self.shuffle = config['shuffle']
+        self.drop_last = config['drop_last']
+
         # generate kv list.
-        self.key_list, tensors_list = utils.dict_to_kvlist(tensors_dict)
-        # load tensors.
-        datasets = TensorDataset(*tensors_list)
-        self.dataloader = DataLoader(datasets, **dl_config)
+        self.key_list, self.tensors_list = utils.dict_to_kvlist(tensors_dict)
+        self.size = len(self.tensors_list[0])
+        if any(len(tensor) != self.size for tensor in self.tensors_list):
+            raise AssertionError('size mismatch between tensors')
+        self.num_samples = self.size if config['num_samples'] is None else config['num_samples']
+        if self.num_samples < self.size or (self.num_samples and not self.size):
+            raise AssertionError(f'num_samples {self.num_samples} is invalid for size {self.size}')
+        # batch dict can be built by zip if keys are not nested.
+        self.nested = any('|' in key for key in self.key_list)
 
     def __iter__(self):
         return DictDataLoaderIter(self)
 
     def __len__(self):
-        return len(self.dataloader)
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
 
 class DictDataLoaderIter():
     '''
@@ -51,15 +72,36 @@ class DictDataLoaderIter():
 
     def __init__(self, loader: DictDataLoader):
         self.loader = loader
-        self.iter = iter(loader.dataloader)
+        self.step = 0
+        self.perm = None
+        device = loader.tensors_list[0].device
+        if loader.shuffle:
+            self.perm = torch.randperm(loader.size, device=device)
+        if loader.num_samples > loader.size:
+            perm = self.perm if self.perm is not None else torch.arange(0, loader.size, device=device)
+            repeats = torch.randint(0, loader.size, (loader.num_samples - loader.size,), device=device)
+            self.perm = torch.cat([perm, repeats])
 
     def __iter__(self):
         return self
 
     def __next__(self):
         '''
-            sample data from self.dataloader, then combine all sub tensors
-            into a dict. stop when dataloder raise exception
+            slice a batch from all tensors, then combine them
+            into a dict. stop when all batches are fetched.
         '''
-        batch: List[torch.Tensor] = next(self.iter)
-        return utils.kvlist_to_dict(self.loader.key_list, batch)
+        loader = self.loader
+        if self.step >= len(loader):
+            raise StopIteration
+        begin = self.step * loader.batch_size
+        end = min(begin + loader.batch_size, loader.num_samples)
+        self.step += 1
+
+        if self.perm is None:
+            batch = [tensor[begin: end] for tensor in loader.tensors_list]
+        else:
+            index = self.perm[begin: end]
+            batch = [tensor.index_select(0, index) for tensor in loader.tensors_list]
+        if loader.nested:
+            return utils.kvlist_to_dict(loader.key_list, batch)
+        return dict(zip(loader.key_list, batch))
@@ -0,0 +1,109 @@
+'''
+    on-disk example store.
+    examples are appended chunk by chunk, and read back by np.memmap,
+    so they can be larger than memory and reused by next run.
+'''
+
+import json
+import os
+from typing import Dict, Iterable
+import numpy as np
+import torch
+
+class ExampleStore():
+    '''
+        [DESCRIPTION]
+          examples saved in a dir, header.json records version, example num,
+          dtype of each column, key of the source data and names of extra arrays.
+          column `name` is a raw array in `name.bin`, extra array `name` is
+          saved by np.save in `name.npy`.
+        [PARAMS]
+          `root`: store dir, written by ExampleStore.write.
+    '''
+
+    # header file name.
+    HEADER = 'header.json'
+
+    # store format version.
+    VERSION = 2
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, self.HEADER)) as header:
+            self.header = json.load(header)
+        if self.header.get('version') != self.VERSION:
+            raise AssertionError(f'unsupported example store version: {self.header.get("version")}')
+
+    def __len__(self):
+        return self.header['num']
+
+    @classmethod
+    def exists(cls, root: str, key: dict = None) -> bool:
+        '''
+            whether a completely written store is in root.
+              `key`: if given, store must be written with same key.
+        '''
+        try:
+            with open(os.path.join(root, cls.HEADER)) as header:
+                header = json.load(header)
+        except (OSError, ValueError):
+            return False
+        if header.get('version') != cls.VERSION:
+            return False
+        return key is None or header.get('key') == json.loads(json.dumps(key))
+
+    @classmethod
+    def write(cls, root: str, chunks: Iterable[Dict[str, np.ndarray]], dtypes: Dict[str, type],
+              key: dict = None, extras: Dict[str, np.ndarray] = None) -> 'ExampleStore':
+        '''
+            write examples chunk by chunk.
+              `chunks`: dicts of 1-dim arrays, same length in a chunk.
+              `dtypes`: saved dtype of each column.
+              `key`: json-serializable description of source data, such as graph,
+              meta paths and config, checked by exists before reusing store.
+              `extras`: arrays saved along with examples, such as negative tables.
+        '''
+        # header is written last, so an interrupted writing leaves no store.
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(os.path.join(root, cls.HEADER)):
+            os.remove(os.path.join(root, cls.HEADER))
+        num = 0
+        files = {name: open(os.path.join(root, f'{name}.bin'), 'wb') for name in dtypes}
+        try:
+            for chunk in chunks:
+                for name, file in files.items():
+                    np.ascontiguousarray(chunk[name], dtype=dtypes[name]).tofile(file)
+                num += len(chunk[next(iter(files))])
+        finally:
+            for file in files.values():
+                file.close()
+        extras = extras or dict()
+        for name, array in extras.items():
+            np.save(os.path.join(root, f'{name}.npy'), array)
+
+        with open(os.path.join(root, cls.HEADER), 'w') as header:
+            json.dump({
+                'version': cls.VERSION,
+                'num': num,
+                'dtypes': {name: np.dtype(dtype).str for name, dtype in dtypes.items()},
+                'key': key,
+                'extras': list(extras)
+            }, header)
+        return cls(root)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        ''' memory-mapped column arrays, copy on write '''
+        res = dict()
+        for name, dtype in self.header['dtypes'].items():
+            path = os.path.join(self.root, f'{name}.bin')
+            res[name] = np.memmap(path, dtype=dtype, mode='c', shape=(len(self),)) if len(self) \
+                else np.zeros(0, dtype=dtype)
+        return res
+
+    def extras(self) -> Dict[str, np.ndarray]:
+        ''' extra arrays saved along with examples '''
+        return {name: np.load(os.path.join(self.root, f'{name}.npy')) for name in self.header['extras']}
+
+    def tensors(self) -> Dict[str, torch.Tensor]:
+        ''' memory-mapped column tensors, for DictDataLoader '''
+        return {name: torch.from_numpy(array) for name, array in self.arrays().items()}
@@ -1,17 +1,30 @@
 '''
     graph.py
 '''
-from typing import List, Tuple
+import os
+import random
+from array import array
+from typing import List, Tuple, Dict, Iterator
 from uuid import uuid1
+import numpy as np
 
 def uuid(classtype: type, uid: str = None):
     ''' myself uuid generater '''
     return classtype.__name__ + '|' + (uid if uid else str(uuid1()))
 
+def _attributes(obj) -> Dict[str, object]:
+    ''' attributes of vertex or edge object, except uuid. '''
+    names = [name for cls in type(obj).__mro__ for name in getattr(cls, '__slots__', ())]
+    names += [*getattr(obj, '__dict__', {})]
+    return {name: getattr(obj, name, None) for name in names
+            if name not in ('uuid', '_uuid', '__dict__', '__weakref__')}
+
 class Vertex:
     '''
         vertex define.
     '''
+    __slots__ = ('uuid',)
+
     def __init__(self, vid=None):
         self.uuid = uuid(self.__class__, vid)
 
@@ -23,14 +36,28 @@ class Vertex:
     @property
     def vid(self):
         ''' return vertex vid [NOTE: not uuid] '''
-        return self.uuid.split('|')[1]
+        return self.uuid[len(self.__class__.__name__) + 1:]
 
 class Edge:
     '''
         edge define.
+        uuid is generated when first asked for, if eid not given.
     '''
+    __slots__ = ('_uuid',)
+
     def __init__(self, eid=None):
-        self.uuid = uuid(self.__class__, eid)
+        self._uuid = uuid(self.__class__, eid) if eid else None
+
+    @property
+    def uuid(self):
+        ''' return edge uuid '''
+        if self._uuid is None:
+            self._uuid = uuid(self.__class__)
+        return self._uuid
+
+    @uuid.setter
+    def uuid(self, value: str):
+        self._uuid = value
 
     @property
     def category(self):
@@ -40,81 +67,396 @@ class Edge:
     @property
     def mid(self):
         ''' return edge mid [NOTE: not uuid] '''
-        return self.uuid.split('|')[1]
+        return self.uuid[len(self.__class__.__name__) + 1:]
 
-class Route:
+class Records:
     '''
-        an route in graph
+        columnar store of vertices or edges, each one is an integer handle.
+        objects are created only when asked for by handle, and they are
+        detached copies: modifying them does not change graph.
+          `classes`: record classes, indexed by category id.
+          `categories`: category id of each record.
+          `uuids`: uuid of each record, None for edge whose uuid is made from handle.
+          `rows`: row of each record in its category attribute table.
+          `tables`: attribute columns of each category.
     '''
+
     def __init__(self):
-        self.path = []
+        self.classes: List[type] = []
+        self.category_ids: Dict[str, int] = dict()
+        self.categories = array('h')
+        self.uuids: List[str] = []
+        self.rows = array('i')
+        self.tables: List[Dict[str, list]] = []
+        self.counts: List[int] = []
+
+    def category_id(self, category: type) -> int:
+        ''' return category id, register category if new '''
+        cid = self.category_ids.get(category.__name__)
+        if cid is None:
+            cid = len(self.classes)
+            self.category_ids[category.__name__] = cid
+            self.classes.append(category)
+            self.tables.append(dict())
+            self.counts.append(0)
+        return cid
+
+    def append(self, category: type, uuids: List[str], columns: Dict[str, list]) -> int:
+        '''
+            append records of same category in bulk, return first handle.
+              `columns`: attribute name to values, same length as uuids.
+        '''
+        cid = self.category_id(category)
+        handle, num = len(self.uuids), len(uuids)
+        table, row = self.tables[cid], self.counts[cid]
+        for name in columns:
+            if name not in table:
+                table[name] = row * [None]
+        for name, column in table.items():
+            column.extend(columns[name] if name in columns else num * [None])
+        self.categories.extend(array('h', [cid]) * num)
+        self.rows.extend(range(row, row + num))
+        self.uuids.extend(uuids)
+        self.counts[cid] += num
+        return handle
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def __getitem__(self, handle: int):
+        cid = self.categories[handle]
+        cls = self.classes[cid]
+        obj = cls.__new__(cls)
+        obj.uuid = self.uuids[handle] or uuid(cls, str(handle))
+        row = self.rows[handle]
+        for name, column in self.tables[cid].items():
+            if column[row] is not None:
+                setattr(obj, name, column[row])
+        return obj
+
+    def __iter__(self) -> Iterator:
+        return (self[handle] for handle in range(0, len(self)))
+
+class Route:
+    '''
+        an route in graph, saved as graph vertex indices and edge handles.
+        vertex and edge objects are created when asked for.
+    '''
+    __slots__ = ('graph', 'vis', 'ehs')
+
+    def __init__(self, graph: 'Graph'):
+        self.graph = graph
+        self.vis = array('i')
+        self.ehs = array('i')
+
+    @property
+    def path(self) -> List[Tuple[Edge, Vertex]]:
+        ''' return route (edge, vertex) sequences, edge of head vertex is None '''
+        return [(self.graph.edges[eh] if eh >= 0 else None, self.graph.vertices[vi])
+                for eh, vi in zip(self.ehs, self.vis)]
 
     @property
     def vertices(self):
         ''' return route vertex sequences '''
-        return [x[1] for x in self.path]
+        return [self.graph.vertices[vi] for vi in self.vis]
 
-    def append(self, edge: Edge, next_vertex: Vertex):
-        ''' append new vertex to current route '''
-        self.path.append((edge, next_vertex))
+    def append(self, edge: int, next_vertex: int):
+        ''' append new vertex index to current route, -1 edge handle for head '''
+        self.ehs.append(edge)
+        self.vis.append(next_vertex)
 
     def __str__(self):
         ''' convert route to str sequence '''
-        res = ''
-        for _, vertex in self.path:
-            res += vertex.uuid
-        return res
+        return ''.join([self.graph.vertices.uuids[vi] for vi in self.vis])
+
+class CSR:
+    '''
+        compressed sparse row view of graph adjacency, for vectorized walk.
+        neighbors of vertex vi whose category id is cid are:
+          indices[indptr[vi * category_num + cid]: indptr[vi * category_num + cid + 1]]
+          `edges`: edge handles, aligned with indices.
+          `categories`: category id of each vertex.
+    '''
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, edges: np.ndarray,
+                 categories: np.ndarray, category_num: int):
+        self.indptr = indptr
+        self.indices = indices
+        self.edges = edges
+        self.categories = categories
+        self.category_num = category_num
+
+    def save(self, root: str):
+        '''
+            save arrays to .npy files under root dir.
+        '''
+        np.save(os.path.join(root, 'indptr.npy'), self.indptr)
+        np.save(os.path.join(root, 'indices.npy'), self.indices)
+        np.save(os.path.join(root, 'edges.npy'), self.edges)
+        np.save(os.path.join(root, 'categories.npy'), self.categories)
+        np.save(os.path.join(root, 'category_num.npy'), np.array(self.category_num))
+
+    @staticmethod
+    def load(root: str, mmap_mode='r') -> 'CSR':
+        '''
+            load csr saved by save(), arrays are memory-mapped by default,
+            so processes loading same csr share pages.
+        '''
+        return CSR(np.load(os.path.join(root, 'indptr.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(root, 'indices.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(root, 'edges.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(root, 'categories.npy'), mmap_mode=mmap_mode),
+                   int(np.load(os.path.join(root, 'category_num.npy'))))
+
+def _records_to_arrays(prefix: str, records: Records) -> Dict[str, np.ndarray]:
+    ''' dump records and their (string) attribute tables to arrays. '''
+    arrays = {
+        f'{prefix}_classes': np.array([cls.__name__ for cls in records.classes], dtype=str),
+        f'{prefix}_categories': np.frombuffer(records.categories, dtype=np.int16).copy(),
+        f'{prefix}_rows': np.frombuffer(records.rows, dtype=np.intc).astype(np.int64),
+        f'{prefix}_has_uuids': np.array([val is not None for val in records.uuids], dtype=bool),
+        f'{prefix}_uuids': np.array(['' if val is None else val for val in records.uuids], dtype=str)
+    }
+    for cid, table in enumerate(records.tables):
+        arrays[f'{prefix}_{cid}_attrs'] = np.array([*table], dtype=str)
+        for name, column in table.items():
+            arrays[f'{prefix}_{cid}_has_{name}'] = np.array([val is not None for val in column], dtype=bool)
+            arrays[f'{prefix}_{cid}_attr_{name}'] = np.array(['' if val is None else val for val in column], dtype=str)
+    return arrays
+
+def _arrays_to_records(prefix: str, arrays: Dict[str, np.ndarray], classes: Dict[str, type]) -> Records:
+    ''' recover records from arrays returned by _records_to_arrays. '''
+    records = Records()
+    for name in arrays[f'{prefix}_classes'].tolist():
+        records.category_id(classes[name])
+    records.categories = array('h', arrays[f'{prefix}_categories'].tolist())
+    records.rows = array('i', arrays[f'{prefix}_rows'].tolist())
+    records.uuids = [val if has else None for val, has in
+                     zip(arrays[f'{prefix}_uuids'].tolist(), arrays[f'{prefix}_has_uuids'].tolist())]
+    records.counts = np.bincount(arrays[f'{prefix}_categories'], minlength=len(records.classes)).tolist()
+    for cid, table in enumerate(records.tables):
+        for name in arrays[f'{prefix}_{cid}_attrs'].tolist():
+            table[name] = [val if has else None for val, has in
+                           zip(arrays[f'{prefix}_{cid}_attr_{name}'].tolist(),
+                               arrays[f'{prefix}_{cid}_has_{name}'].tolist())]
+    return records
 
 class Graph:
     '''
         graph struct define.
-        contain vertices and edges.
+        contain vertices and edges, both are integer handles into columnar
+        Records, objects are created only when asked for.
+        added edges are appended to flat (head, tail, edge handle) arrays, and
+        compacted to a CSR partitioned by neighbor category when graph is read,
+        so memory and insert cost scale with edges num instead of N^2,
+        and neighbor lookup / random choice cost O(degree) / O(1).
+        edge between same vertices pair is overrided by the later one.
     '''
 
     def __init__(self):
-        self.vertices = []
-        self.edges = []
-        self.uuids_map = dict()
+        self.vertices = Records()
+        self.edges = Records()
+        self.heads = array('i')
+        self.tails = array('i')
+        self.handles = array('i')
+        self.uuids_map: Dict[str, int] = dict()
+        self.category_ids = self.vertices.category_ids
+        self._csr = None
+        self._pairs = None
 
     def vertex(self, vid: str, category: type) -> Vertex:
         '''
             return vertex according to vid, None if not found
         '''
         vi = self.uuids_map.get(uuid(category, vid), None)
-        return self.vertices[vi] if vi else None
+        return self.vertices[vi] if vi is not None else None
+
+    def _segment(self, vi: int, cid: int) -> Tuple[int, int]:
+        # csr indices range of neighbors of vi whose category id is cid.
+        if cid is None:
+            return 0, 0
+        csr = self.csr()
+        slot = vi * csr.category_num + cid
+        return int(csr.indptr[slot]), int(csr.indptr[slot + 1])
+
+    def edge_handles(self, heads: np.ndarray, tails: np.ndarray) -> np.ndarray:
+        '''
+            return handles of edges from vertex indices heads to tails, -1 if not found.
+        '''
+        self.csr()
+        pairs, handles = self._pairs
+        keys = np.asarray(heads, dtype=np.int64) << 32 | np.asarray(tails, dtype=np.int64)
+        index = np.minimum(np.searchsorted(pairs, keys), max(len(pairs) - 1, 0))
+        found = pairs[index] == keys if len(pairs) else np.zeros(keys.shape, dtype=bool)
+        return np.where(found, handles[index] if len(pairs) else -1, -1)
+
+    def edge_handle(self, vh: int, vt: int) -> int:
+        '''
+            return handle of edge from vertex index vh to vt, None if not found.
+        '''
+        handle = int(self.edge_handles([vh], [vt])[0])
+        return handle if handle >= 0 else None
 
     def adj(self, vertex: Vertex, category: type) -> List[Tuple[Edge, Vertex]]:
         '''
             return adjcents vertices for specific vertex whose category is
             same as given category.
         '''
-        vid = self.uuids_map[vertex.uuid]
-        adjs = [i for i in range(0, len(self.vertices)) if self.edges[vid][i]]
-        # reserve nodes whose class name equal to category class name
-        adjs = [*filter(lambda i: self.vertices[i].category == category.__name__, adjs)]
-        return [(self.edges[vid][i], self.vertices[i]) for i in adjs]
+        csr = self.csr()
+        cid = self.category_ids.get(category.__name__)
+        begin, end = self._segment(self.uuids_map[vertex.uuid], cid)
+        return [(self.edges[eh], self.vertices[vi]) for vi, eh in
+                zip(csr.indices[begin: end].tolist(), csr.edges[begin: end].tolist())]
 
-    def add_vertex(self, vertex: Vertex):
+    def random_adj(self, vertex: Vertex, category: type) -> Tuple[Edge, Vertex]:
+        '''
+            return a random adjcent vertex for specific vertex whose category
+            is same as given category, None if no such vertex.
+        '''
+        csr = self.csr()
+        cid = self.category_ids.get(category.__name__)
+        begin, end = self._segment(self.uuids_map[vertex.uuid], cid)
+        if begin == end:
+            return None
+        i = random.randrange(begin, end)
+        return self.edges[int(csr.edges[i])], self.vertices[int(csr.indices[i])]
+
+    def add_vertex(self, vertex: Vertex) -> int:
         '''
             add new vertex, if new vertex uuid has existed, skip it.
+            return vertex index in graph.
         '''
-        for exist_vertex in self.vertices:
-            if exist_vertex.uuid == vertex.uuid:
-                return
+        vi = self.uuids_map.get(vertex.uuid)
+        if vi is not None:
+            return vi
 
         # add vertex, update map dict.
-        self.vertices.append(vertex)
-        self.uuids_map.update({vertex.uuid:len(self.vertices) - 1})
+        attributes = {name: [val] for name, val in _attributes(vertex).items()}
+        vi = self.vertices.append(type(vertex), [vertex.uuid], attributes)
+        self.uuids_map[vertex.uuid] = vi
+        self._csr = None
+        return vi
+
+    def add_vertices(self, vertices: List[Vertex]) -> List[int]:
+        '''
+            add vertices in bulk, existed vertices are skipped.
+            return vertex indices in graph, same order as given.
+        '''
+        return [self.add_vertex(vertex) for vertex in vertices]
 
-        # expand edge array.
-        self.edges.append((len(self.vertices) - 1) * [None])
-        for edge_row in self.edges:
-            edge_row.append(None)
+    def add_vertex_columns(self, category: type, vids: List[str], **columns: List) -> np.ndarray:
+        '''
+            add vertices of same category in bulk without creating objects,
+            existed vertices (and repeated vid) are skipped.
+              `vids`: vertex vids.
+              `columns`: vertex attribute values, same length as vids.
+              `return`: vertex indices in graph, same order as vids.
+        '''
+        prefix = category.__name__ + '|'
+        uuids = [prefix + vid for vid in vids]
+        vis = np.empty(len(uuids), dtype=np.int64)
+        rows = []
+        for i, vertex_uuid in enumerate(uuids):
+            vi = self.uuids_map.get(vertex_uuid)
+            if vi is None:
+                vi = len(self.vertices) + len(rows)
+                self.uuids_map[vertex_uuid] = vi
+                rows.append(i)
+            vis[i] = vi
+        columns = {name: [*column] for name, column in columns.items()}
+        self.vertices.append(category, [uuids[i] for i in rows],
+                             {name: [column[i] for i in rows] for name, column in columns.items()})
+        self._csr = None
+        return vis
+
+    def add_edge_columns(self, category: type, num: int, **columns: List) -> np.ndarray:
+        '''
+            create edges of same category in bulk without creating objects.
+              `columns`: edge attribute values, length is num.
+              `return`: edge handles, use for add_edges.
+        '''
+        columns = {name: [*column] for name, column in columns.items()}
+        handle = self.edges.append(category, num * [None], columns)
+        return np.arange(handle, handle + num)
 
     def add_edge(self, vh: Vertex, vt: Vertex, edge: Edge):
         '''
             add new edge, if vertex not exist, raise error.
+            edge between same vertices pair will be overrided.
+        '''
+        self.add_edges([self.uuids_map[vh.uuid]], [self.uuids_map[vt.uuid]], [edge])
+
+    def add_edges(self, heads: List[int], tails: List[int], edges: List[Edge] or np.ndarray):
+        '''
+            add edges in bulk.
+              `heads`, `tails`: vertex indices returned by add_vertex(es).
+              `edges`: edge objects (same object in a call is saved once), or edge
+              handles returned by add_edge_columns, same length as heads and tails.
+        '''
+        if not isinstance(edges, np.ndarray):
+            handles = dict()
+            for edge in edges:
+                if id(edge) not in handles:
+                    attributes = {name: [val] for name, val in _attributes(edge).items()}
+                    handles[id(edge)] = self.edges.append(type(edge), [edge.uuid], attributes)
+            edges = [handles[id(edge)] for edge in edges]
+        self.heads.frombytes(np.asarray(heads, dtype=np.intc).tobytes())
+        self.tails.frombytes(np.asarray(tails, dtype=np.intc).tobytes())
+        self.handles.frombytes(np.asarray(edges, dtype=np.intc).tobytes())
+        self._csr = None
+
+    def csr(self) -> CSR:
+        '''
+            return csr view of graph, rebuilt only if graph changed.
+            neighbors keep the order they are first added.
+        '''
+        if self._csr is None:
+            category_num = len(self.category_ids)
+            categories = np.frombuffer(self.vertices.categories, dtype=np.int16).copy()
+            heads = np.frombuffer(self.heads, dtype=np.intc).astype(np.int64)
+            tails = np.frombuffer(self.tails, dtype=np.intc).astype(np.int64)
+            handles = np.frombuffer(self.handles, dtype=np.intc)
+            # same vertices pair: keep first position and last edge.
+            pairs = heads << 32 | tails
+            _, first, inverse = np.unique(pairs, return_index=True, return_inverse=True)
+            last = np.zeros(len(first), dtype=np.int64)
+            np.maximum.at(last, inverse.ravel(), np.arange(0, len(pairs)))
+            slots = heads[first] * category_num + categories[tails[first]]
+            order = np.lexsort((first, slots))
+            degrees = np.bincount(slots, minlength=len(categories) * category_num)
+            indptr = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(degrees)])
+            self._csr = CSR(indptr, tails[first][order].astype(np.int32),
+                            handles[last][order].astype(np.int32), categories, category_num)
+            # sorted vertices pairs and their edge, for edge lookup.
+            self._pairs = (pairs[first], handles[last].astype(np.int64))
+        return self._csr
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        '''
+            dump graph to numpy arrays, keep neighbors order.
+            only string attributes of vertices and edges are supported.
+        '''
+        csr = self.csr()
+        degrees = np.diff(csr.indptr).reshape(-1, max(csr.category_num, 1)).sum(-1)
+        arrays = {
+            'heads': np.repeat(np.arange(0, len(degrees)), degrees),
+            'tails': csr.indices.astype(np.int64),
+            'eids': csr.edges.astype(np.int64)
+        }
+        arrays.update(_records_to_arrays('vertex', self.vertices))
+        arrays.update(_records_to_arrays('edge', self.edges))
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays: Dict[str, np.ndarray], classes: List[type]) -> 'Graph':
+        '''
+            recover graph from arrays returned by to_arrays.
+              `classes`: all vertex and edge classes used in graph.
         '''
-        vi1 = self.uuids_map[vh.uuid]
-        vi2 = self.uuids_map[vt.uuid]
-        self.edges[vi1][vi2] = edge
+        classes = {cls.__name__: cls for cls in classes}
+        graph = Graph()
+        graph.vertices = _arrays_to_records('vertex', arrays, classes)
+        graph.edges = _arrays_to_records('edge', arrays, classes)
+        graph.category_ids = graph.vertices.category_ids
+        graph.uuids_map = {vertex_uuid: vi for vi, vertex_uuid in enumerate(graph.vertices.uuids)}
+        graph.add_edges(arrays['heads'], arrays['tails'], arrays['eids'])
+        return graph
@@ -0,0 +1,52 @@
+'''
+    optimizers for sparse embedding training.
+'''
+
+import torch
+from torch.optim import Optimizer
+
+class RowWiseAdagrad(Optimizer):
+    '''
+        [DESCRIPTION]
+          adagrad keeping one accumulator per embedding row instead of per
+          element, for sparse gradients of Embedding(sparse=True). step cost
+          scales with rows in batch, state is [row num] instead of [row num, dim].
+        [PARAMS]
+          `params`: 2-dim parameters with sparse gradients.
+          `lr`: learning rate.
+          `eps`: term added to denominator for numerical stability.
+    '''
+
+    def __init__(self, params, lr=1e-1, eps=1e-10):
+        Optimizer.__init__(self, params, {'lr': lr, 'eps': eps})
+
+    def _state(self, param: torch.Tensor) -> dict:
+        # accumulator of each row, created at first use.
+        state = self.state[param]
+        if not state:
+            state['sum'] = torch.zeros(param.shape[0], dtype=param.dtype, device=param.device)
+        return state
+
+    def share_memory(self):
+        ''' move accumulators to shared memory, for hogwild training by several processes '''
+        for group in self.param_groups:
+            for param in group['params']:
+                self._state(param)['sum'].share_memory_()
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        ''' update rows with gradient in batch only '''
+        loss = closure() if closure is not None else None
+        for group in self.param_groups:
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                if not param.grad.is_sparse:
+                    raise AssertionError('RowWiseAdagrad only supports sparse gradient')
+                grad = param.grad.coalesce()
+                rows, values = grad.indices()[0], grad.values()
+                state = self._state(param)
+                state['sum'].index_add_(0, rows, values.pow(2).mean(-1))
+                std = state['sum'][rows].sqrt_().add_(group['eps'])
+                param.index_add_(0, rows, values / std[:, None], alpha=-group['lr'])
+        return loss
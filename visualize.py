@@ -2,14 +2,13 @@
     visualize.py
 '''
 
-import json
-import torch
+from typing import List
+import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.manifold import TSNE
-from model import SimiModel
+from checkpoint import Checkpoint
 from dataset import Instance, Kpi, Alarm
-from tokenizer import Tokenizer
-# from utils.graph import Graph
+from export import export_embeddings, export_json
 
 COLOR = {
     Alarm.__name__: 'r',
@@ -17,39 +16,80 @@ COLOR = {
     Instance.__name__: 'g'
 }
 
+# dtype of binary embeddings export, float32, float16 or int8.
+EXPORT_DTYPE = 'float32'
+
+# also dump embs to json lines.
+EXPORT_JSON = False
+
+# 2-d projection, 'pca', or 'tsne' on pca reduced embs.
+PROJECTION = 'pca'
+
+# pca reduced size before tsne.
+PCA_SIZE = 50
+
+# max dots num of each category, randomly sampled, all if None.
+SAMPLE_PER_CATEGORY = 20000
+
+def _pca(embs: np.ndarray, size: int) -> np.ndarray:
+    ''' project embs to top `size` principal components, by eigen decomposition of covariance '''
+    embs = embs - embs.mean(0)
+    _, vectors = np.linalg.eigh(embs.T @ embs)
+    return embs @ vectors[:, ::-1][:, :size]
+
+def _stratified_sample(categories: np.ndarray, num: int, seed=0) -> np.ndarray:
+    ''' indices of at most `num` random rows of each category, in order '''
+    if num is None:
+        return np.arange(0, len(categories))
+    rng = np.random.default_rng(seed)
+    res = [np.zeros(0, np.int64)]
+    for category in np.unique(categories):
+        rows = np.flatnonzero(categories == category)
+        res.append(rng.choice(rows, num, replace=False) if len(rows) > num else rows)
+    return np.sort(np.concatenate(res))
+
+def project(embs: np.ndarray, categories: List[str]) -> tuple:
+    '''
+        project embs to 2-d dots for drawing.
+          `categories`: category of each emb, for stratified sampling.
+          `return`: [dots num, 2] dots and indices of sampled embs.
+    '''
+    rows = _stratified_sample(np.asarray(categories), SAMPLE_PER_CATEGORY)
+    embs = np.asarray(embs, dtype=np.float32)[rows]
+    if PROJECTION == 'pca':
+        return _pca(embs, 2), rows
+    if PROJECTION == 'tsne':
+        return TSNE(n_jobs=-1).fit_transform(_pca(embs, min(PCA_SIZE, embs.shape[1]))), rows
+    raise AssertionError(f'unknown projection: {PROJECTION}')
+
 def main():
     ''' main '''
-    # load saved
-    saved = torch.load('./saved.bin', map_location=torch.device('cpu'))
-    # graph: Graph = saved['graph']
-    tokenizer: Tokenizer = saved['tokenizer']
-    model: SimiModel = saved['model']
+    # load embeddings and vocabulary only.
+    checkpoint = Checkpoint('./checkpoint')
+    origin_embs = checkpoint.embeddings()
+    uuids, category_ids, category_names = checkpoint.vocabulary()
+    categories = [category_names[cid] for cid in category_ids.tolist()]
+    vids = [uuid[len(category) + 1:] for uuid, category in zip(uuids.tolist(), categories)]
 
     # fit embeddings.
-    origin_embs = model.embs(torch.LongTensor(range(0, model.embs.num_embeddings)))
-    origin_embs = origin_embs.cpu().detach().numpy()
-    tsne = TSNE()
-    embs = tsne.fit_transform(origin_embs)
+    embs, rows = project(origin_embs, categories)
 
-    # draw dots.
+    # draw dots, one scatter for each category, clip outliers.
     plt.switch_backend('agg')
-    for i, dot in enumerate(embs):
-        if abs(dot[0]) > 20 or abs(dot[1]) > 20:
-            continue
-        vertex = tokenizer.decode([i])[0]
-        plt.scatter(*dot, c=COLOR[vertex.category])
+    sampled = np.asarray(categories)[rows]
+    for category, color in COLOR.items():
+        dots = embs[sampled == category]
+        plt.scatter(dots[:, 0], dots[:, 1], c=color, s=1, label=category)
+    lows, highs = np.percentile(embs, [0.5, 99.5], 0) if len(embs) else ([0, 0], [1, 1])
+    plt.xlim(lows[0], highs[0])
+    plt.ylim(lows[1], highs[1])
+    plt.legend()
     plt.savefig('visual.jpg')
 
-    # dump embs to json.
-    with open('./embs.json', 'w') as out:
-        for i, emb in enumerate(origin_embs):
-            vertex = tokenizer.decode([i])[0]
-            info = {
-                'id': vertex.vid,
-                'category': vertex.category,
-                'emb': emb.tolist()
-            }
-            out.write(json.dumps(info) + '\n')
+    # export embs as binary matrix and index.
+    export_embeddings('./embs', origin_embs, vids, categories, EXPORT_DTYPE)
+    if EXPORT_JSON:
+        export_json('./embs.json', origin_embs, vids, categories)
 
 if __name__ == '__main__':
     main()